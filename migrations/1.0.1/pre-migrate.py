@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """Re-mark duplicate fiscalized POS orders before the unique index is created.
+
+    ``_zimra_fiscalized_uniq`` allows one fiscalized order per name. The oldest
+    order of each name stays fiscalized; the others become exempted and keep
+    their fiscal data so they can be reconciled by hand.
+    """
+    cr.execute("""
+        UPDATE pos_order o
+           SET zimra_status = 'exempted',
+               zimra_error = 'Invoice ' || o.name || ' already fiscalized in order ' || d.keep_id
+          FROM (
+                SELECT name, MIN(id) AS keep_id
+                  FROM pos_order
+                 WHERE zimra_status = 'fiscalized'
+              GROUP BY name
+                HAVING COUNT(*) > 1
+               ) d
+         WHERE o.name = d.name
+           AND o.zimra_status = 'fiscalized'
+           AND o.id != d.keep_id
+    """)
+    if cr.rowcount:
+        _logger.warning("Re-marked %d duplicate fiscalized POS orders as exempted", cr.rowcount)
@@ -1,13 +1,31 @@
 # -*- coding: utf-8 -*-
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError, ValidationError
-import json
+from odoo.fields import Domain
+from .zimra_config import ZimraPermanentError, ZimraStatusPendingError, ZimraUncertainError, _dumps_compact
+import random
 import re
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
 _logger = logging.getLogger(__name__)
 
+_RE_TIN = re.compile(r'TIN[:=]\s*(\d+)')
+_RE_VAT = re.compile(r'VAT[:=]\s*(\d+)')
+_RE_HS = re.compile(r'\b\d{8,}\b')
+_RE_WS = re.compile(r'\s+')
+
+# The retry cron gives up on an invoice after this many attempts
+_CRON_MAX_RETRIES = 3
+# Retried invoices committed together, so one cron run is not a single long transaction
+_CRON_COMMIT_BATCH = 50
+# Invoices retried per cron run (ir.config_parameter zimra_fiscal.retry_batch); the rest wait for the next tick
+_CRON_RETRY_BATCH = 200
+
+# Bound formatters for the 2/3-decimal amounts in the fiscal payload
+_f2 = '{:.2f}'.format
+_f3 = '{:.3f}'.format
+
 
 class AccountMove(models.Model):
     _inherit = 'account.move'
@@ -28,6 +46,8 @@ class AccountMove(models.Model):
     zimra_sent_date = fields.Datetime('ZIMRA Sent Date', readonly=True, copy=False)
     zimra_fiscalized_date = fields.Datetime('ZIMRA Fiscalized Date', readonly=True, copy=False)
     zimra_retry_count = fields.Integer('Retry Count', default=0, copy=False)
+    # Set while Fiscal Harmony holds an accepted document whose status was never read
+    zimra_request_id = fields.Char('ZIMRA Request ID', readonly=True, copy=False)
 
     # Additional ZIMRA fields
     zimra_qr_code = fields.Char('ZIMRA QR Code', readonly=True, copy=False)
@@ -35,6 +55,9 @@ class AccountMove(models.Model):
     fiscal_pdf_attachment_id = fields.Many2one('ir.attachment', 'Fiscal PDF', readonly=True, copy=False)
     fiscalized_pdf = fields.Char('Fiscalized Pdf', readonly=True, copy=False)
 
+    # Covers exactly the rows the retry cron looks at
+    _zimra_retry_idx = models.Index("(zimra_retry_count, zimra_sent_date) WHERE zimra_status = 'failed'")
+
     def action_fiscalize_invoice(self):
         """Manual fiscalization action for invoices"""
         self.ensure_one()
@@ -123,25 +146,10 @@ class AccountMove(models.Model):
                 )
 
             # Download PDF using config's method
-            pdf_data = config.download_pdf(self.fiscalized_pdf)
-
-            if isinstance(pdf_data, str):  # Success - PDF data returned
-                # Create or update the PDF attachment
-                attachment_vals = {
-                    'name': f'FiscalInvoice_{self.name}.pdf',
-                    'type': 'binary',
-                    'datas': pdf_data,
-                    'res_model': 'account.move',
-                    'res_id': self.id,
-                    'mimetype': 'application/pdf',
-                    'description': f'Fiscal PDF for invoice {self.name}',
-                }
+            pdf_data = config.download_pdf_content(self.fiscalized_pdf)
 
-                if self.fiscal_pdf_attachment_id:
-                    self.fiscal_pdf_attachment_id.write(attachment_vals)
-                else:
-                    attachment = self.env['ir.attachment'].create(attachment_vals)
-                    self.fiscal_pdf_attachment_id = attachment.id
+            if isinstance(pdf_data, bytes):  # Success - PDF bytes returned
+                self._store_fiscal_pdf(pdf_data)
 
                 return self._show_notification(
                     'PDF Downloaded',
@@ -164,13 +172,25 @@ class AccountMove(models.Model):
                 'danger'
             )
 
-    def _send_to_zimra(self):
-        """Send invoice to ZIMRA with improved error handling"""
+    def _send_to_zimra(self, config=None, tax_mappings=None, currency_mappings=None):
+        """Send invoice to ZIMRA with improved error handling
+
+        ``config`` and the mapping dicts can be passed in by batch callers
+        (e.g. the retry cron) so they are resolved once per company instead
+        of once per invoice.
+        """
         self.ensure_one()
 
+        # Collected while sending and written together with the outcome,
+        # so each record gets a single UPDATE
+        move_vals = {}
+        log_vals = {}
+        zimra_invoice = self.env['zimra.invoice']
+
         try:
             # Get configuration
-            config = self._get_active_zimra_config()
+            if config is None:
+                config = self._get_active_zimra_config()
             if not config:
                 self._mark_as_failed('No active ZIMRA configuration found for this company')
                 return False
@@ -181,10 +201,8 @@ class AccountMove(models.Model):
                 _logger.info(f"Invoice {self.name} marked as exempted from fiscalization")
                 return True
 
-
-
             try:
-                invoice_data = self._prepare_zimra_invoice_data(config)
+                invoice_data = self._prepare_zimra_invoice_data(config, tax_mappings, currency_mappings)
             except Exception as e:
                 # This will capture the actual error and include it in the failed message
                 self._mark_as_failed(f'Failed to prepare invoice data : {e}')
@@ -194,102 +212,169 @@ class AccountMove(models.Model):
                 self._mark_as_failed('Failed to prepare invoice data for ZIMRA: returned empty or None')
                 return False
 
-            # Create invoice log
-            zimra_invoice = self._create_zimra_invoice_log(invoice_data)
+            # Serialize once: the same compact body is logged and sent
+            fiscal_invoice = _dumps_compact(invoice_data)
 
-            # Update status before sending
-            self.write({
-                'zimra_sent_date': fields.Datetime.now(),
+            sent_date = fields.Datetime.now()
+            move_vals.update({
+                'zimra_sent_date': sent_date,
                 'zimra_retry_count': self.zimra_retry_count + 1,
             })
 
-            zimra_invoice.write({
-                'status': 'sent',
-                'sent_date': self.zimra_sent_date,
-            })
-
-            # Prepare fiscal data
-            fiscal_invoice = json.dumps(invoice_data, separators=(',', ':'), ensure_ascii=False)
+            # Create invoice log, already marked as sent
+            zimra_invoice = self._create_zimra_invoice_log(fiscal_invoice, sent_date)
 
             # Determine endpoint
             endpoint = self._determine_endpoint(invoice_data)
 
             # Send to ZIMRA
-            _logger.info(f"Sending invoice {self.name} to ZIMRA endpoint: {endpoint}")
-            response_data = config.send_fiscal_data(fiscal_invoice, endpoint)
+            if self.zimra_request_id:
+                # Accepted by an earlier attempt whose status was never read: poll it
+                # instead of posting the document a second time
+                _logger.info(f"Polling ZIMRA request {self.zimra_request_id} for invoice {self.name}")
+                response_data, response_text = config.check_fiscal_request(self.zimra_request_id)
+            else:
+                _logger.info(f"Sending invoice {self.name} to ZIMRA endpoint: {endpoint}")
+                response_data, response_text = config.send_fiscal_data(fiscal_invoice, endpoint, return_raw=True)
 
             if not response_data:
-                self._mark_as_failed('No response received from ZIMRA server', zimra_invoice)
+                self._mark_as_failed('No response received from ZIMRA server', zimra_invoice,
+                                     move_vals=move_vals, log_vals=log_vals)
                 return False
 
-            # Store response
-            self.zimra_response = json.dumps(response_data, indent=2) if response_data else ''
-            zimra_invoice.write({'response_data': self.zimra_response})
+            # Store the response body as received (compact JSON, shown as stored)
+            move_vals['zimra_response'] = log_vals['response_data'] = response_text or _dumps_compact(response_data)
 
             # Process response
-            return self._process_zimra_response(response_data, zimra_invoice)
+            return self._process_zimra_response(response_data, zimra_invoice, move_vals, log_vals)
 
         except Exception as e:
             error_msg = f"Exception during fiscalization: {str(e)}"
+            if isinstance(e, ZimraStatusPendingError):
+                # Accepted but unread: the retry cron polls this request instead of re-sending
+                move_vals['zimra_request_id'] = e.request_id
+            elif isinstance(e, ZimraUncertainError):
+                # May have been recorded and there is no request id to check: keep the
+                # retry cron from posting it again, a manual check and retry is needed
+                error_msg = f"{error_msg} Check the document on Fiscal Harmony before retrying."
+                move_vals['zimra_retry_count'] = max(
+                    move_vals.get('zimra_retry_count', self.zimra_retry_count), _CRON_MAX_RETRIES)
+            elif isinstance(e, ZimraPermanentError) and self.zimra_request_id:
+                # The polled request is unknown or expired: stop polling it and
+                # leave the invoice to a manual check and retry
+                error_msg = f"{error_msg} Check the document on Fiscal Harmony before retrying."
+                move_vals['zimra_request_id'] = False
+                move_vals['zimra_retry_count'] = max(
+                    move_vals.get('zimra_retry_count', self.zimra_retry_count), _CRON_MAX_RETRIES)
             _logger.exception(f"Error fiscalizing invoice {self.name}")
-            self._mark_as_failed(error_msg, zimra_invoice if 'zimra_invoice' in locals() else None)
+            self._mark_as_failed(error_msg, zimra_invoice, move_vals=move_vals, log_vals=log_vals)
             return False
 
-    def _process_zimra_response(self, response_data, zimra_invoice):
-        """Process ZIMRA response with better error handling"""
+    def _process_zimra_response(self, response_data, zimra_invoice, move_vals=None, log_vals=None):
+        """Process ZIMRA response with better error handling
+
+        ``move_vals``/``log_vals`` carry values collected earlier in the send;
+        they are written in the same call as the outcome.
+        """
+        move_vals = dict(move_vals or {})
+        log_vals = dict(log_vals or {})
         try:
             response = response_data[0] if isinstance(response_data, list) else response_data
 
             if self._is_fiscalization_successful(response):
-                qr_data = response.get("QrData", {})
+                qr_data = response.get("QrData") or {}
 
                 # pull from both top level and QrData for safety
-                fiscal_day = response.get("FiscalDay") or qr_data.get("FiscalDay", "")
-                invoice_number = response.get("InvoiceNumber") or qr_data.get("InvoiceNumber", "")
+                fiscal_day = response.get("FiscalDay") or qr_data.get("FiscalDay") or ""
+                invoice_number = response.get("InvoiceNumber") or qr_data.get("InvoiceNumber") or ""
 
                 if not fiscal_day or not invoice_number:
                     self._mark_as_failed(
                         f'Incomplete response from ZIMRA:{response}: missing FiscalDay or InvoiceNumber',
-                        zimra_invoice
+                        zimra_invoice, move_vals=move_vals, log_vals=log_vals,
                     )
                     return False
 
-                self.write({
+                fiscal_number = f"{invoice_number}/{fiscal_day}"
+                fiscalized_date = fields.Datetime.now()
+
+                move_vals.update({
                     'zimra_status': 'fiscalized',
-                    'zimra_fiscal_number': f"{invoice_number}/{fiscal_day}",
-                    'zimra_fiscalized_date': fields.Datetime.now(),
-                    'zimra_qr_code': qr_data.get('QrCodeUrl', ''),
-                    'zimra_verification_url': qr_data.get('VerificationCode', ''),
-                    'fiscalized_pdf': response.get('FiscalInvoicePdf', ''),
+                    'zimra_fiscal_number': fiscal_number,
+                    'zimra_fiscalized_date': fiscalized_date,
+                    'zimra_qr_code': qr_data.get('QrCodeUrl') or '',
+                    'zimra_verification_url': qr_data.get('VerificationCode') or '',
+                    'fiscalized_pdf': response.get('FiscalInvoicePdf') or '',
                     'zimra_error': False,
+                    'zimra_request_id': False,
                 })
+                self.write(move_vals)
 
-                zimra_invoice.write({
+                log_vals.update({
                     'status': 'fiscalized',
-                    'zimra_fiscal_number': self.zimra_fiscal_number,
-                    'fiscalized_date': self.zimra_fiscalized_date,
+                    'zimra_fiscal_number': fiscal_number,
+                    'fiscalized_date': fiscalized_date,
                 })
+                zimra_invoice.write(log_vals)
 
                 _logger.info(
-                    f"Successfully fiscalized invoice {self.name} - Fiscal Number: {self.zimra_fiscal_number}"
+                    f"Successfully fiscalized invoice {self.name} - Fiscal Number: {fiscal_number}"
                 )
                 return True
 
             else:
                 error_msg = response.get('Error', 'Unknown error from ZIMRA')
                 fiscal_number = response.get('fiscal_number', response.get('RequestId', ''))
-                self._mark_as_failed(error_msg, zimra_invoice, fiscal_number)
+                # Answered with an error: a later attempt sends the document again
+                move_vals['zimra_request_id'] = False
+                self._mark_as_failed(error_msg, zimra_invoice, fiscal_number,
+                                     move_vals=move_vals, log_vals=log_vals)
                 return False
 
         except Exception as e:
             error_msg = f"Error processing ZIMRA response: {str(e)}"
             _logger.exception(f"Error processing response for invoice {self.name}")
-            self._mark_as_failed(error_msg, zimra_invoice)
+            self._mark_as_failed(error_msg, zimra_invoice, move_vals=move_vals, log_vals=log_vals)
             return False
 
-    def _mark_as_failed(self, error_message, zimra_invoice=None, fiscal_number=None):
-        """Mark invoice as failed with error details"""
+    def _store_fiscal_pdf(self, pdf_data):
+        """Create or update the invoice's fiscal PDF attachment from raw bytes.
+
+        The attachment is looked up by res_model/res_id/name when the invoice is
+        not linked to one (e.g. after a status reset), so repeated downloads
+        reuse the same record instead of piling up copies.
+        """
+        self.ensure_one()
+        name = f'FiscalInvoice_{self.name}.pdf'
+        # 'raw' skips the base64 round-trip
+        attachment_vals = {
+            'name': name,
+            'type': 'binary',
+            'raw': pdf_data,
+            'res_model': 'account.move',
+            'res_id': self.id,
+            'mimetype': 'application/pdf',
+            'description': f'Fiscal PDF for invoice {self.name}',
+        }
+
+        attachment = self.fiscal_pdf_attachment_id or self.env['ir.attachment'].search([
+            ('res_model', '=', 'account.move'),
+            ('res_id', '=', self.id),
+            ('name', '=', name),
+        ], limit=1)
+        if attachment:
+            attachment.write(attachment_vals)
+        else:
+            attachment = self.env['ir.attachment'].create(attachment_vals)
+
+        if self.fiscal_pdf_attachment_id != attachment:
+            self.fiscal_pdf_attachment_id = attachment
+        return attachment
+
+    def _mark_as_failed(self, error_message, zimra_invoice=None, fiscal_number=None, move_vals=None, log_vals=None):
+        """Mark invoice as failed with error details, flushing any pending values in the same write"""
         self.write({
+            **(move_vals or {}),
             'zimra_status': 'failed',
             'zimra_error': error_message,
             'zimra_fiscal_number': fiscal_number or self.zimra_fiscal_number,
@@ -297,6 +382,7 @@ class AccountMove(models.Model):
 
         if zimra_invoice:
             zimra_invoice.write({
+                **(log_vals or {}),
                 'status': 'failed',
                 'error_message': error_message,
                 'zimra_fiscal_number': fiscal_number,
@@ -320,51 +406,47 @@ class AccountMove(models.Model):
         return not response.get("Error")
 
     def _should_fiscalize(self):
-        """Check if invoice should be fiscalized with detailed logging"""
-        # Only fiscalize customer invoices and credit notes
-        if not self.is_invoice(include_receipts=True):
-            _logger.debug(f"Invoice {self.name}: Not an invoice type")
-            return False
-
-        # Skip if already fiscalized or exempted
-        if self.zimra_status in ['fiscalized', 'exempted']:
-            _logger.debug(f"Invoice {self.name}: Already {self.zimra_status}")
-            return False
-
-        # Skip if invoice is not posted
-        if self.state != 'posted':
-            _logger.debug(f"Invoice {self.name}: Not posted (state: {self.state})")
-            return False
-
-        # Only customer invoices and credit notes
-        if self.move_type not in ['out_invoice', 'out_refund']:
-            _logger.debug(f"Invoice {self.name}: Invalid move_type: {self.move_type}")
+        """Check if invoice should be fiscalized: posted customer invoices and credit notes only"""
+        # move_type covers is_invoice(include_receipts=True) as well, so one check is enough
+        if (self.move_type not in ('out_invoice', 'out_refund')
+                or self.state != 'posted'
+                or self.zimra_status in ('fiscalized', 'exempted')):
+            _logger.debug(
+                "Invoice %s: not fiscalizable (move_type: %s, state: %s, zimra_status: %s)",
+                self.name, self.move_type, self.state, self.zimra_status,
+            )
             return False
 
-        _logger.debug(f"Invoice {self.name}: Should be fiscalized")
         return True
 
     def _get_active_zimra_config(self):
         """Get active ZIMRA configuration using only the warehouse"""
 
 
-        config = self.env['zimra.config'].search([
-            ('company_id', '=', self.company_id.id),
-            ('active', '=', True)
-        ], limit=1)
+        config = self.env['zimra.config'].get_company_config(self.company_id.id)
 
         if not config:
             _logger.error(f"No active ZIMRA configuration found for Company {self.company_id.name}")
 
         return config
 
-    def _create_zimra_invoice_log(self, invoice_data):
-        """Create ZIMRA invoice log entry"""
+    @api.model
+    def _retry_backoff_seconds(self, retry_count):
+        """Seconds to wait after the last attempt before the cron retries an invoice"""
+        return min(3600, 30 * 2 ** retry_count) + random.random() * 5
+
+    def _get_zimra_mappings(self, config):
+        """Return the (tax_mappings, currency_mappings) code dicts for a config"""
+        return config._get_tax_code_map(), config._get_currency_code_map()
+
+    def _create_zimra_invoice_log(self, request_data, sent_date):
+        """Create the ZIMRA invoice log entry, already marked as sent"""
         return self.env['zimra.invoice'].create({
             'name': self.name,
             'account_move_id': self.id,
-            'status': 'pending',
-            'request_data': json.dumps(invoice_data, indent=2),
+            'status': 'sent',
+            'sent_date': sent_date,
+            'request_data': request_data,
             'company_id': self.company_id.id,
         })
 
@@ -381,33 +463,39 @@ class AccountMove(models.Model):
 
         return "/invoice"
 
-    def _prepare_zimra_invoice_data(self, config):
+    def _prepare_zimra_invoice_data(self, config, tax_mappings=None, currency_mappings=None):
         """Prepare invoice data for ZIMRA format with validation"""
         try:
             if not config:
                 raise ValidationError(f"Invoice {self.name}: No ZIMRA configuration provided")
 
             # Get tax and currency mappings
-            if not config.tax_mapping_ids:
+            if tax_mappings is None or currency_mappings is None:
+                tax_mappings, currency_mappings = self._get_zimra_mappings(config)
+
+            if not tax_mappings:
                 raise ValidationError(f"Invoice {self.name}: No tax mappings defined in ZIMRA config {config.name}")
 
-            if not config.currency_mapping_ids:
+            if not currency_mappings:
                 raise ValidationError(
                     f"Invoice {self.name}: No currency mappings defined in ZIMRA config {config.name}")
 
-            tax_mappings = {tm.odoo_tax_id.id: tm for tm in config.tax_mapping_ids}
-            currency_mappings = {cm.odoo_currency_id.id: cm for cm in config.currency_mapping_ids}
+            # Load every header field used below in a single query
+            self.fetch([
+                'name', 'move_type', 'state', 'ref', 'invoice_date', 'currency_id', 'partner_id',
+                'reversed_entry_id', 'amount_untaxed', 'amount_tax', 'amount_total', 'zimra_retry_count',
+            ])
 
             # Get currency code
             currency_code = 'USD'  # Default
             if self.currency_id.id in currency_mappings:
-                currency_code = currency_mappings[self.currency_id.id].zimra_currency_code
+                currency_code = currency_mappings[self.currency_id.id]
 
             # Prepare buyer contact
             buyer_contact = self._get_buyer_contact()
 
             # Prepare line items
-            line_items = self._get_line_items(tax_mappings)
+            line_items, has_discount = self._get_line_items(tax_mappings)
 
             if not line_items:
                 raise ValidationError(f"Invoice {self.name}: No valid line items found. "
@@ -418,7 +506,6 @@ class AccountMove(models.Model):
 
             # Determine if this is a credit note
             is_credit_note = self.move_type == 'out_refund'
-            has_discount = any(line.discount > 0 for line in self.invoice_line_ids)
 
             if is_credit_note:
                 data = {
@@ -431,9 +518,9 @@ class AccountMove(models.Model):
                     "BuyerContact": buyer_contact,
                     "Date": timestamp,
                     "LineItems": line_items,
-                    "SubTotal": f"{abs(self.amount_untaxed):.2f}",
-                    "TotalTax": f"{abs(self.amount_tax):.2f}",
-                    "Total": f"{abs(self.amount_total):.2f}",
+                    "SubTotal": _f2(abs(self.amount_untaxed)),
+                    "TotalTax": _f2(abs(self.amount_tax)),
+                    "Total": _f2(abs(self.amount_total)),
                     "CurrencyCode": currency_code,
                     "IsRetry": bool(self.zimra_retry_count > 0),
                 }
@@ -447,9 +534,9 @@ class AccountMove(models.Model):
                     "BuyerContact": buyer_contact,
                     "Date": timestamp,
                     "LineItems": line_items,
-                    "SubTotal": f"{self.amount_untaxed:.2f}",
-                    "TotalTax": f"{self.amount_tax:.2f}",
-                    "Total": f"{self.amount_total:.2f}",
+                    "SubTotal": _f2(self.amount_untaxed),
+                    "TotalTax": _f2(self.amount_tax),
+                    "Total": _f2(self.amount_total),
                     "CurrencyCode": currency_code,
                     "IsRetry": bool(self.zimra_retry_count > 0),
                 }
@@ -488,23 +575,38 @@ class AccountMove(models.Model):
         if not vat_string:
             return None, None
 
-        match_tin = re.search(r'TIN[:=]\s*(\d+)', vat_string)
+        match_tin = _RE_TIN.search(vat_string)
         tin = match_tin.group(1) if match_tin else ''
 
-        match_vat = re.search(r'VAT[:=]\s*(\d+)', vat_string)
+        match_vat = _RE_VAT.search(vat_string)
         vat = match_vat.group(1) if match_vat else ''
 
         return tin, vat
 
     def _get_line_items(self, tax_mappings):
-        """Get line items in ZIMRA format with validation"""
+        """Get line items in ZIMRA format with validation
+
+        :return: ``(line_items, has_discount)``; the discount flag is collected in the same pass
+        """
         line_items = []
+        has_discount = False
 
-        for line in self.invoice_line_ids:
-            # Skip non-product lines
-            if line.display_type in ['line_section', 'line_note']:
-                continue
+        # Skip non-product lines
+        lines = self.invoice_line_ids.filtered(lambda l: l.display_type not in ('line_section', 'line_note'))
 
+        # Prefetch the line, product and tax columns the loop reads, one query per model
+        lines.fetch([
+            'name', 'display_type', 'quantity', 'price_unit', 'discount',
+            'price_subtotal', 'price_total', 'tax_ids', 'product_id',
+        ])
+        products = lines.product_id
+        product_fields = ['name']
+        if 'l10n_hs_code' in products._fields:
+            product_fields.append('l10n_hs_code')
+        products.fetch(product_fields)
+
+        for line in lines:
+            has_discount = has_discount or line.discount > 0
             try:
                 line_item = self._prepare_line_item(line, tax_mappings)
                 if line_item:
@@ -513,7 +615,7 @@ class AccountMove(models.Model):
                 _logger.error(f"Error preparing line item for {line.name}: {str(e)}")
                 continue
 
-        return line_items
+        return line_items, has_discount
 
     def _prepare_line_item(self, line, tax_mappings):
         """Prepare a single line item with error handling"""
@@ -521,14 +623,8 @@ class AccountMove(models.Model):
         if line.display_type in ('line_section', 'line_note'):
             return None
 
-        # Calculate tax information
-        tax_code = ""
-        if line.tax_ids:
-            for tax in line.tax_ids:
-                _logger.info(f"Preparing tax code {line.tax_ids.name}")
-                if tax.id in tax_mappings:
-                    tax_code = tax_mappings[tax.id].zimra_tax_code
-                    break
+        # Calculate tax information: first mapped tax wins
+        tax_code = next((tax_mappings[tax_id] for tax_id in line.tax_ids.ids if tax_id in tax_mappings), "")
 
         # Parse product name and HS code
         name, hscode = self._parse_product_name(line)
@@ -551,12 +647,12 @@ class AccountMove(models.Model):
         # Build line item
         return {
             "Description": name or line.name or "",
-            "UnitAmount": f"{unit_amount:.3f}",
+            "UnitAmount": _f3(unit_amount),
             "TaxCode": tax_code,
             "ProductCode": hscode or "",
-            "LineAmount": f"{line_total:.2f}",
-            "DiscountAmount": f"{discount_amount:.2f}",
-            "Quantity": f"{quantity:.3f}",
+            "LineAmount": _f2(line_total),
+            "DiscountAmount": _f2(discount_amount),
+            "Quantity": _f3(quantity),
         }
 
     def _parse_product_name(self, line):
@@ -565,20 +661,22 @@ class AccountMove(models.Model):
             # Fallback for service or manual line
             return line.name or "Service", ''
 
-        # Safely check if product has HS code field
-        hscode = getattr(line.product_id, 'l10n_hs_code', '') or ''
-        name = line.product_id.name or "Unnamed Product"
+        product = line.product_id
+
+        # The HS code field only exists when a localization module adds it
+        hscode = (product.l10n_hs_code or '') if 'l10n_hs_code' in product._fields else ''
+        name = product.name or "Unnamed Product"
 
         if not hscode:
             try:
                 # Look for an 8+ digit HS code in the product name
-                match = re.search(r'\b\d{8,}\b', name)
+                match = _RE_HS.search(name)
                 if match:
                     hscode = match.group()
                     # Remove the HS code from the name
-                    name = re.sub(r'\b' + re.escape(hscode) + r'\b', '', name).strip()
+                    name = (name[:match.start()] + name[match.end():]).strip()
                     # Clean up multiple spaces
-                    name = re.sub(r'\s+', ' ', name)
+                    name = _RE_WS.sub(' ', name)
             except ValueError:
                 _logger.warning(f"Regex failed when parsing product name for line '{line.name}'")
                 pass
@@ -586,19 +684,15 @@ class AccountMove(models.Model):
         return name, hscode
 
     def _create_timestamp(self, date_field):
-        """Create timestamp in ISO format"""
+        """Create timestamp in ISO format; callers pass invoice_date, i.e. a date"""
         if not date_field:
-            date_field = fields.Datetime.now()
-
-        if isinstance(date_field, str):
-            return date_field
+            return fields.Datetime.now().replace(microsecond=0).isoformat()
 
-        # Convert date to datetime if needed
-        if hasattr(date_field, 'hour'):  # Already datetime
+        if type(date_field) is datetime:
             return date_field.replace(microsecond=0).isoformat()
-        else:  # It's a date
-            dt = datetime.combine(date_field, datetime.min.time())
-            return dt.replace(microsecond=0).isoformat()
+
+        # Midnight of the invoice date
+        return datetime(date_field.year, date_field.month, date_field.day).isoformat()
 
     def _get_customer_address(self):
         """Get customer address as a structured dictionary"""
@@ -667,28 +761,24 @@ class AccountMove(models.Model):
                     'fiscal_pdf_attachment_id': False,
                     'fiscalized_pdf': False,
                     'zimra_retry_count': 0,
+                    # The reposted invoice is a new document: send it, do not poll the old request
+                    'zimra_request_id': False,
                 })
                 _logger.info(f"Reset ZIMRA status for invoice {move.name}")
 
         return result
 
-    @api.model
-    def create(self, vals):
+    @api.model_create_multi
+    def create(self, vals_list):
         """Override create to set initial ZIMRA status"""
-        move = super(AccountMove, self).create(vals)
+        moves = super(AccountMove, self).create(vals_list)
 
-        # Set initial status for invoices
-        if move.is_invoice() and move.move_type in ['out_invoice', 'out_refund']:
-            move.zimra_status = 'pending'
-
-
-        else:
-            move.zimra_status = 'exempted'
+        # Set initial status for invoices: one write per group rather than per move
+        customer_invoices = moves.filtered(lambda m: m.move_type in ('out_invoice', 'out_refund'))
+        customer_invoices.filtered(lambda m: m.zimra_status != 'pending').write({'zimra_status': 'pending'})
+        (moves - customer_invoices).write({'zimra_status': 'exempted'})
 
-        return move
-
-    def write(self, vals):
-        return super().write(vals)
+        return moves
 
     # ==================== Action Methods ====================
 
@@ -735,29 +825,64 @@ class AccountMove(models.Model):
     @api.model
     def cron_retry_failed_fiscalization(self):
         """Cron job to retry failed fiscalization for invoices"""
-        # Only retry invoices with less than 3 attempts
-        failed_invoices = self.search([
-            ('zimra_status', '=', 'failed'),
-            ('zimra_retry_count', '<', 3),
-            ('state', '=', 'posted')
-        ])
+        # Back off exponentially so a ZIMRA outage is not hammered on every tick.
+        # Only retry invoices with less than 3 attempts; each attempt count gets
+        # its own cutoff so the whole predicate runs in SQL.
+        now = fields.Datetime.now()
+        backoff_domain = Domain.OR(
+            Domain('zimra_retry_count', '=', retry_count) & (
+                Domain('zimra_sent_date', '=', False)
+                | Domain('zimra_sent_date', '<', now - timedelta(seconds=self._retry_backoff_seconds(retry_count)))
+            )
+            for retry_count in range(_CRON_MAX_RETRIES)
+        )
+        limit = int(self.env['ir.config_parameter'].sudo().get_param(
+            'zimra_fiscal.retry_batch', _CRON_RETRY_BATCH))
+        # Least-retried first, so invoices close to giving up do not starve the others
+        failed_invoices = self.search(
+            Domain('zimra_status', '=', 'failed') & Domain('state', '=', 'posted') & backoff_domain,
+            limit=limit, order='zimra_retry_count, id',
+        )
 
         _logger.info(f"Cron: Found {len(failed_invoices)} failed invoices to retry")
 
         success_count = 0
         fail_count = 0
 
-        for invoice in failed_invoices:
-            try:
-                result = invoice._send_to_zimra()
-                if result:
-                    success_count += 1
-                    _logger.info(f"Cron: Successfully retried fiscalization for invoice: {invoice.name}")
-                else:
+        # Bulk retries must not spawn a chatter message per status change
+        failed_invoices = failed_invoices.with_context(
+            tracking_disable=True,
+            mail_create_nolog=True,
+            mail_notrack=True,
+        )
+
+        # Warm the cache with every partner field the payload reads, in two queries for the whole batch
+        partners = failed_invoices.partner_id
+        partners.fetch(['name', 'vat', 'company_registry', 'phone', 'email', 'street', 'street2', 'city', 'state_id'])
+        partners.state_id.fetch(['name'])
+
+        # Resolve the config and mapping dicts once per company, not per invoice
+        for company, invoices in failed_invoices.grouped('company_id').items():
+            config = invoices[:1]._get_active_zimra_config()
+            tax_mappings, currency_mappings = self._get_zimra_mappings(config) if config else (None, None)
+
+            for invoice in invoices:
+                try:
+                    # One bad invoice must not roll back the others
+                    with self.env.cr.savepoint():
+                        result = invoice._send_to_zimra(config, tax_mappings, currency_mappings)
+                    if result:
+                        success_count += 1
+                        _logger.info(f"Cron: Successfully retried fiscalization for invoice: {invoice.name}")
+                    else:
+                        fail_count += 1
+                        _logger.warning(f"Cron: Retry failed for invoice {invoice.name}: {invoice.zimra_error}")
+                except Exception as e:
                     fail_count += 1
-                    _logger.warning(f"Cron: Retry failed for invoice {invoice.name}: {invoice.zimra_error}")
-            except Exception as e:
-                fail_count += 1
-                _logger.exception(f"Cron: Exception during retry for invoice {invoice.name}")
+                    _logger.exception(f"Cron: Exception during retry for invoice {invoice.name}")
+
+                # Keep what was sent so far even if the run is killed mid-way
+                if (success_count + fail_count) % _CRON_COMMIT_BATCH == 0 and not self.env.registry.in_test_mode():
+                    self.env.cr.commit()
 
         _logger.info(f"Cron completed: {success_count} successful, {fail_count} failed")
@@ -1,15 +1,50 @@
 # -*- coding: utf-8 -*-
 from odoo import models, fields, api
-import json
-import requests
+import functools
 import logging
+import random
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from odoo.exceptions import UserError
+from .zimra_config import ZimraPermanentError, ZimraStatusPendingError, ZimraUncertainError, _dumps_compact
+from psycopg2.errors import UniqueViolation
 
 _logger = logging.getLogger(__name__)
 
+_RE_HS = re.compile(r'\b\d{8,}\b')
+_RE_TIN_VAT = re.compile(r'(TIN|VAT)[:=]\s*(\d+)')
+_RE_REFUND = re.compile(r'\s+REFUND$')
+# Product names marking a discount line: receipt-level discounts, and any discount/loyalty line
+_RE_RECEIPT_DISCOUNT = re.compile(r'%|discount|loyalty', re.IGNORECASE)
+_RE_DISCOUNT = re.compile(r'discount|loyalty|voucher|% off', re.IGNORECASE)
+
+# Queued orders sent per cron run; each send waits ~6 s on ZIMRA, so keep a run
+# well inside the cron time limit. A full batch re-triggers the cron right away
+_FISCAL_QUEUE_BATCH = 10
+
+# Failed orders are retried this many times, spaced by a jittered exponential backoff
+_RETRY_MAX_ATTEMPTS = 3
+_RETRY_BACKOFF_BASE = 30
+_RETRY_BACKOFF_CAP = 3600
+# Failed orders re-queued per cron run (ir.config_parameter zimra_fiscal.retry_batch)
+_RETRY_BATCH = 200
+
+# Bound formatters for the 2/3-decimal amounts in the fiscal payload
+_f2 = '{:.2f}'.format
+_f3 = '{:.3f}'.format
+
+
+@functools.lru_cache(maxsize=4096)
+def _split_hs_code(name):
+    """Split a product name into (name without HS code, HS code); cached per distinct name"""
+    match = _RE_HS.search(name)
+    if not match:
+        return name, ""
+    hscode = match.group()
+    # Remove every occurrence of the HS code from the name
+    return re.sub(r'\b' + re.escape(hscode) + r'\b', '', name).strip(), hscode
+
 
 class PosOrder(models.Model):
     _inherit = 'pos.order'
@@ -31,6 +66,9 @@ class PosOrder(models.Model):
     zimra_sent_date = fields.Datetime(' Sent Date', readonly=True, copy=False)
     zimra_fiscalized_date = fields.Datetime(' Fiscalized Date', readonly=True, copy=False)
     zimra_retry_count = fields.Integer('Retry Count', default=0, copy=False)
+    zimra_next_retry_at = fields.Datetime('Next Retry', readonly=True, copy=False)
+    # Set while Fiscal Harmony holds an accepted document whose status was never read
+    zimra_request_id = fields.Char('FiscalHarmony Request ID', readonly=True, copy=False)
 
     # Additional ZIMRA fields
     zimra_qr_code = fields.Char(' QR Data', readonly=True, copy=False)
@@ -45,6 +83,12 @@ class PosOrder(models.Model):
     # Add field to store PDF attachment ID
     fiscal_pdf_attachment_id = fields.Many2one('ir.attachment', 'Fiscal PDF', readonly=True, copy=False)
 
+    # Orders waiting in the fiscalization queue (attempted but not sent yet)
+    _zimra_queue_idx = models.Index("(id) WHERE zimra_attempted AND zimra_status = 'pending'")
+    _zimra_fiscalized_uniq = models.UniqueIndex("(name) WHERE zimra_status = 'fiscalized'")
+    # Failed orders still eligible for the retry cron
+    _zimra_failed_idx = models.Index("(zimra_retry_count, zimra_next_retry_at) WHERE zimra_status = 'failed'")
+
     def action_fiscalize_manual(self):
         """Manual fiscalization action"""
         self.ensure_one()
@@ -88,10 +132,18 @@ class PosOrder(models.Model):
                 }
             }
 
-    def _send_to_zimra(self):
-        """Send invoice to ZIMRA using signed request from config"""
+    def _send_to_zimra(self, config=None):
+        """Send invoice to ZIMRA using signed request from config
+
+        ``config`` may be passed by batch callers (the crons) that already
+        resolved it for the order's warehouse.
+        """
         self.ensure_one()
-        
+
+        # Repeated triggers (retry, manual, write) on an already fiscalized order
+        # stop here, before any config lookup or query
+        if self.zimra_status == 'fiscalized':
+            return True
 
         # Skip if name is still the placeholder '/'
         if not self.name or self.name == '/':
@@ -106,7 +158,8 @@ class PosOrder(models.Model):
                 )
                 return False
 
-                # Check if this invoice ID has already been fiscalized
+        # Check if this invoice ID has already been fiscalized (index probe on
+        # _zimra_fiscalized_uniq); never post a duplicate to ZIMRA
         existing_fiscalized = self.search([
             ('name', '=', self.name),
             ('zimra_status', '=', 'fiscalized'),
@@ -114,19 +167,25 @@ class PosOrder(models.Model):
         ], limit=1)
 
         if existing_fiscalized:
-            self.zimra_status = 'exempted'
-            self.zimra_error = f'Invoice {self.name} already fiscalized in order {existing_fiscalized.id}'
+            self.write({
+                'zimra_status': 'exempted',
+                'zimra_error': f'Invoice {self.name} already fiscalized in order {existing_fiscalized.id}',
+            })
             _logger.warning(f"Skipping fiscalization - Invoice {self.name} already fiscalized")
             return True
 
         # Get configuration
-        warehouse = self.session_id.config_id.picking_type_id.warehouse_id
-        config = self.env['zimra.config'].get_active_config(warehouse.id)
-        _logger.info("zimra says warehouse is:%s", warehouse)
+        if config is None:
+            warehouse = self.session_id.config_id.picking_type_id.warehouse_id
+            config = self.env['zimra.config'].get_active_config(warehouse.id)
+            _logger.debug("zimra says warehouse is:%s", warehouse)
 
         if not config:
-            self.zimra_status = 'failed'
-            self.zimra_error = 'No active FiscalHarmony configuration found'
+            self.write({
+                'zimra_status': 'failed',
+                'zimra_error': 'No active FiscalHarmony configuration found',
+                'zimra_next_retry_at': self._zimra_next_retry_at(self.zimra_retry_count),
+            })
             _logger.error(f"No ZIMRA configuration found for company {self.company_id.name}")
             return False
 
@@ -135,31 +194,36 @@ class PosOrder(models.Model):
             self.zimra_status = 'exempted'
             return True
 
+        # Collected while sending and written together with the outcome,
+        # so each record gets a single UPDATE
+        vals = {}
+        log_vals = {}
+        zimra_invoice = self.env['zimra.invoice']
+        payload_ready = False
+
         try:
             # Prepare ZIMRA invoice data
             invoice_data = self._prepare_zimra_invoice_data(config)
+            payload_ready = True
+
+            # Serialize once: the same compact body is logged and sent
+            fiscal_invoice = _dumps_compact(invoice_data)
 
-            # Log the invoice
+            # Log the invoice, already marked as sent
+            sent_date = fields.Datetime.now()
             zimra_invoice = self.env['zimra.invoice'].create({
                 'name': self.name,
                 'pos_order_id': self.id,
-                'status': 'pending',
-                'request_data': json.dumps(invoice_data, indent=2),
+                'status': 'sent',
+                'sent_date': sent_date,
+                'request_data': fiscal_invoice,
                 'company_id': self.company_id.id,
             })
-
-            # Update fields before sending
-            self.zimra_sent_date = fields.Datetime.now()
-            self.zimra_retry_count += 1
-
-            # Update invoice log
-            zimra_invoice.write({
-                'status': 'sent',
-                'sent_date': self.zimra_sent_date,
+            vals.update({
+                'zimra_sent_date': sent_date,
+                'zimra_retry_count': self.zimra_retry_count + 1,
             })
 
-            fiscal_invoice = json.dumps(invoice_data, separators=(',', ':'), ensure_ascii=False)
-
             invoice_id = invoice_data.get("InvoiceId", "").strip().lower()
 
             # Check for CreditNoteId first
@@ -171,16 +235,20 @@ class PosOrder(models.Model):
             else:
                 endpoint = "/invoice"
             # Use the signed request method from config
-            response_data = config.send_fiscal_data(fiscal_invoice, endpoint)
-            _logger.info("zimra says:%s", response_data)
-
-            # Store the response
-            self.zimra_response = json.dumps(response_data) if response_data else ''
+            if self.zimra_request_id:
+                # Accepted by an earlier attempt whose status was never read: poll it
+                # instead of posting the document a second time
+                response_data, response_text = config.check_fiscal_request(self.zimra_request_id)
+            else:
+                response_data, response_text = config.send_fiscal_data(fiscal_invoice, endpoint, return_raw=True)
+            _logger.debug("zimra says:%s", response_data)
 
-            # Update invoice log
-            zimra_invoice.write({
-                'response_data': self.zimra_response,
-            })
+            # Store the response body as received rather than encoding it again
+            if response_data:
+                vals['zimra_response'] = response_text or _dumps_compact(response_data)
+            else:
+                vals['zimra_response'] = ''
+            log_vals['response_data'] = vals['zimra_response']
 
             # Check if fiscalization was successful
             if self._is_fiscalization_successful(response_data):
@@ -188,49 +256,62 @@ class PosOrder(models.Model):
                 response = response_data[0] if response_data else {}
                 fiscalday = response.get("FiscalDay")
                 invoice_number = response.get("InvoiceNumber")
+                fiscal_number = f"{invoice_number}/{fiscalday}"
+                fiscalized_date = fields.Datetime.now()
+
+                vals.update({
+                    'zimra_status': 'fiscalized',
+                    'zimra_fiscal_number': fiscal_number,
+                    'zimra_fiscalized_date': fiscalized_date,
+                    'zimra_qr_code': response.get('QrData'),
+                    'fiscalized_pdf': response.get('FiscalInvoicePdf'),
+                    'zimra_verification_url': response.get('verification_url'),
+                    # Clear any previous errors
+                    'zimra_error': False,
+                    'zimra_next_retry_at': False,
+                    'zimra_request_id': False,
+                })
 
-                self.zimra_status = 'fiscalized'
-                self.zimra_fiscal_number = f"{invoice_number}/{fiscalday}"
-                self.zimra_fiscalized_date = fields.Datetime.now()
-                self.zimra_qr_code = response.get('QrData')
-                self.fiscalized_pdf = response.get('FiscalInvoicePdf')
-                self.zimra_verification_url = response.get('verification_url')
-
-                # Clear any previous errors
-                self.zimra_error = False
-
-                # Update invoice log
-                zimra_invoice.write({
+                # ZIMRA accepted the document: the log records it whatever happens locally
+                log_vals.update({
                     'status': 'fiscalized',
-                    'zimra_fiscal_number': f"{invoice_number}/{fiscalday}",
-                    'fiscalized_date': self.zimra_fiscalized_date,
+                    'zimra_fiscal_number': fiscal_number,
+                    'fiscalized_date': fiscalized_date,
                 })
 
+                # Backstop for the pre-send duplicate check: another order with this
+                # name got fiscalized concurrently (_zimra_fiscalized_uniq)
+                try:
+                    with self.env.cr.savepoint():
+                        self.write(vals)
+                        self.flush_recordset()
+                except UniqueViolation:
+                    self.invalidate_recordset()
+                    error = f'Invoice {self.name} fiscalized by ZIMRA but already fiscalized in another order'
+                    # Keep what ZIMRA returned (fiscal number, QR, PDF) for reconciliation
+                    self.write({
+                        **vals,
+                        'zimra_status': 'exempted',
+                        'zimra_error': error,
+                    })
+                    log_vals['error_message'] = error
+                    zimra_invoice.write(log_vals)
+                    _logger.warning("Invoice %s fiscalized twice - Fiscal Number: %s", self.name, fiscal_number)
+                    return True
+
+                zimra_invoice.write(log_vals)
+
                 _logger.info(
-                    f"Successfully fiscalized POS order {self.name} - Fiscal Number: {self.zimra_fiscal_number}")
+                    f"Successfully fiscalized POS order {self.name} - Fiscal Number: {fiscal_number}")
 
                 # AUTO-DOWNLOAD PDF AFTER SUCCESSFUL FISCALIZATION
                 if self.fiscalized_pdf:
                     try:
                         _logger.info(f"Attempting to auto-download PDF for order {self.name}")
-                        pdf_data = config.download_pdf(self.fiscalized_pdf)
-
-                        if isinstance(pdf_data, str):
-                            attachment_vals = {
-                                'name': f'FiscalInvoice_{self.name}.pdf',
-                                'type': 'binary',
-                                'datas': pdf_data,
-                                'res_model': 'pos.order',
-                                'res_id': self.id,
-                                'mimetype': 'application/pdf',
-                            }
-
-                            if self.fiscal_pdf_attachment_id:
-                                self.fiscal_pdf_attachment_id.write(attachment_vals)
-                            else:
-                                attachment = self.env['ir.attachment'].create(attachment_vals)
-                                self.fiscal_pdf_attachment_id = attachment.id
+                        pdf_data = config.download_pdf_content(self.fiscalized_pdf)
 
+                        if isinstance(pdf_data, bytes):
+                            self._store_fiscal_pdf(pdf_data)
                             _logger.info(f"Successfully auto-downloaded and stored PDF for order {self.name}")
                         else:
                             _logger.warning(
@@ -245,37 +326,118 @@ class PosOrder(models.Model):
             else:
                 # response_data is a list, so get the first element
                 response = response_data[0] if response_data else {}
-
-                self.zimra_status = 'failed'
-                self.zimra_fiscal_number = response.get('fiscal_number', response.get('RequestId'))
-                self.zimra_error = response.get('Error')
+                fiscal_number = response.get('fiscal_number', response.get('RequestId'))
+                error = response.get('Error')
+
+                vals.update({
+                    'zimra_status': 'failed',
+                    'zimra_fiscal_number': fiscal_number,
+                    'zimra_error': error,
+                    'zimra_next_retry_at': self._zimra_next_retry_at(vals['zimra_retry_count']),
+                    # Answered with an error: a later attempt sends the document again
+                    'zimra_request_id': False,
+                })
+                self.write(vals)
 
                 # Update invoice log
-                zimra_invoice.write({
+                log_vals.update({
                     'status': 'failed',
-                    'error_message': self.zimra_error,
-                    'zimra_fiscal_number': self.zimra_fiscal_number,
+                    'error_message': error,
+                    'zimra_fiscal_number': fiscal_number,
                 })
+                zimra_invoice.write(log_vals)
 
                 _logger.error(
-                    f"Failed to fiscalize POS order {self.name} - Error: {self.zimra_error}")
+                    f"Failed to fiscalize POS order {self.name} - Error: {error}")
                 return False
 
         except Exception as e:
             error_msg = str(e)
-            self.zimra_status = 'failed'
-            self.zimra_error = error_msg
+            retry_count = vals.get('zimra_retry_count', self.zimra_retry_count)
+            vals.update({
+                'zimra_status': 'failed',
+                'zimra_error': error_msg,
+            })
+            if isinstance(e, ZimraStatusPendingError):
+                # Accepted but unread: the retry cron polls this request instead of re-sending
+                vals['zimra_request_id'] = e.request_id
+            if isinstance(e, ZimraUncertainError):
+                # May have been recorded and there is no request id to check: sending
+                # again could fiscalize it twice, so leave it to a manual check and retry
+                error_msg = f"{error_msg} Check the document on Fiscal Harmony before retrying."
+                vals.update({
+                    'zimra_error': error_msg,
+                    'zimra_retry_count': max(retry_count, _RETRY_MAX_ATTEMPTS),
+                    'zimra_next_retry_at': False,
+                })
+            elif isinstance(e, ZimraPermanentError) or (isinstance(e, UserError) and not payload_ready):
+                # Rejected by Fiscal Harmony (HTTP 4xx) or refused by payload validation:
+                # resending cannot succeed, so the retry cron leaves it alone until it
+                # is fixed and retried manually
+                if self.zimra_request_id:
+                    # The polled request is unknown or expired: stop polling it
+                    error_msg = f"{error_msg} Check the document on Fiscal Harmony before retrying."
+                vals.update({
+                    'zimra_error': error_msg,
+                    'zimra_retry_count': max(retry_count, _RETRY_MAX_ATTEMPTS),
+                    'zimra_next_retry_at': False,
+                    'zimra_request_id': False,
+                })
+            else:
+                # Anything else (unreachable, busy, status poll failed, ...) may
+                # succeed later: the retry cron tries again after the backoff
+                vals['zimra_next_retry_at'] = self._zimra_next_retry_at(retry_count)
+            self.write(vals)
 
             # Update invoice log if it exists
-            if 'zimra_invoice' in locals():
-                zimra_invoice.write({
+            if zimra_invoice:
+                log_vals.update({
                     'status': 'failed',
                     'error_message': error_msg,
                 })
+                zimra_invoice.write(log_vals)
 
             _logger.error(f"Error fiscalizing POS order {self.name}: {error_msg}")
             return False
 
+    def _store_fiscal_pdf(self, pdf_data):
+        """Create or update the order's fiscal PDF attachment from raw bytes.
+
+        An unlinked attachment of the same order and name is reused, so
+        repeated downloads never pile up copies.
+        """
+        self.ensure_one()
+        name = f'FiscalInvoice_{self.name}.pdf'
+        # 'raw' takes the bytes as-is, no base64 round-trip
+        attachment_vals = {
+            'name': name,
+            'type': 'binary',
+            'raw': pdf_data,
+            'res_model': 'pos.order',
+            'res_id': self.id,
+            'mimetype': 'application/pdf',
+        }
+
+        attachment = self.fiscal_pdf_attachment_id or self.env['ir.attachment'].search([
+            ('res_model', '=', 'pos.order'),
+            ('res_id', '=', self.id),
+            ('name', '=', name),
+        ], limit=1)
+        if attachment:
+            attachment.write(attachment_vals)
+        else:
+            attachment = self.env['ir.attachment'].create(attachment_vals)
+
+        if self.fiscal_pdf_attachment_id != attachment:
+            self.fiscal_pdf_attachment_id = attachment
+        return attachment
+
+    @api.model
+    def _zimra_next_retry_at(self, retry_count):
+        """When a failed order becomes due again: exponential backoff with ±20% jitter, capped"""
+        delay = min(_RETRY_BACKOFF_CAP, _RETRY_BACKOFF_BASE * 2 ** retry_count) * random.uniform(0.8, 1.2)
+        return fields.Datetime.now() + timedelta(seconds=delay)
+
     def _is_fiscalization_successful(self, response_data):
         """Check if fiscalization response indicates success based on 'Error' field."""
         if not response_data or not isinstance(response_data, list):
@@ -335,151 +497,76 @@ class PosOrder(models.Model):
 
     def _prepare_zimra_invoice_data(self, config):
         """Prepare invoice data for ZIMRA format"""
-        # Get tax and currency mappings
-        tax_mappings = {tm.odoo_tax_id.id: tm for tm in config.tax_mapping_ids}
-        currency_mappings = {cm.odoo_currency_id.id: cm for cm in config.currency_mapping_ids}
+        # Get tax and currency code maps (cached on the config, not rebuilt per order)
+        tax_mappings = config._get_tax_code_map()
+        currency_mappings = config._get_currency_code_map()
+
+        # Load every field read below in a handful of queries instead of one per line
+        self.fetch([
+            'name', 'pos_reference', 'date_order', 'currency_id', 'partner_id',
+            'amount_total', 'amount_tax', 'zimra_retry_count', 'lines',
+        ])
+        self.lines.fetch(['product_id', 'tax_ids', 'price_unit', 'qty', 'discount', 'price_subtotal_incl'])
+        self.lines.product_id.fetch(['name'])
+        if self.partner_id:
+            self.partner_id.fetch(['name', 'vat', 'company_registry', 'phone', 'email',
+                                   'street', 'street2', 'city', 'state_id'])
+            self.partner_id.state_id.fetch(['name'])
 
         # Get currency code
-        currency_code = 'USD'  # Default
-        if self.currency_id.id in currency_mappings:
-            currency_code = currency_mappings[self.currency_id.id].zimra_currency_code
+        currency_code = currency_mappings.get(self.currency_id.id, 'USD')
 
         # Prepare buyer contact
         buyer_contact = self.__get_buyer_contact()
 
-        # Prepare line items
-        line_items = self.__get_line_items(tax_mappings)
-
-        # Check if order has any discounts
-        has_discount = any(self.__is_discount_line(line) for line in self.lines)
-
+        # Prepare line items, with the discount totals from the same pass
+        line_items, total_discount, has_discount = self.__get_line_items(tax_mappings)
 
-        # Create timestamp from order date
-        timestamp = self.__create_timestamp(self.date_order)
-        total_discount = sum(
-            float(item.get("DiscountAmount", "0"))
-            for item in line_items
-        )
+        # One timestamp for whichever payload is sent
+        now_iso = self.__create_timestamp(datetime.now())
         subtotal = self.amount_total - total_discount
 
+        # _send_to_zimra has already given the order a real name
         is_refund = self.name.strip().endswith('REFUND')
-        # Ensure order has a valid name
-        if not self.name or self.name == '/':
-            if hasattr(self.config_id, 'sequence_id') and self.config_id.sequence_id:
-                self.name = self.config_id.sequence_id.next_by_id()
-                _logger.info("Assigned sequence name to POS order %s: %s", self.id, self.name)
-            else:
-                _logger.warning("POS config %s has no sequence. Cannot assign order name.", self.config_id.name)
-
-        invoice_name= self.name
-
-        data = {
-            "InvoiceId": invoice_name,
-            "InvoiceNumber": invoice_name,
-            "Reference": self.pos_reference or "",
-            "IsDiscounted": has_discount,
-            "IsTaxInclusive": True,
-            "BuyerContact": buyer_contact,
-            "Date": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-            "LineItems": line_items,
-            "SubTotal": f"{subtotal - self.amount_tax:.2f}",
-            "TotalTax": f"{self.amount_tax:.2f}",
-            "Total": f"{self.amount_total:.2f}",
-            "CurrencyCode": currency_code,
-            "IsRetry": bool(self.zimra_retry_count > 0),
-        }
-
-        creditnote = {
-            "CreditNoteId": self.name,
-            "CreditNoteNumber": self.name,
-            "OriginalInvoiceId": re.sub(r'\s+REFUND$', '', self.name).strip(),
-            "Reference": self.pos_reference or '',
-            "IsTaxInclusive": True,
-            "BuyerContact": buyer_contact,
-            "Date": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-            "LineItems": line_items,
-            "SubTotal": f"{abs(subtotal - self.amount_tax):.2f}",
-            "TotalTax": f"{abs(self.amount_tax):.2f}",
-            "Total": f"{abs(self.amount_total + total_discount):.2f}",
-            "CurrencyCode": currency_code,
-            "IsRetry": bool(self.zimra_retry_count > 0),
-
-        }
-
-        # Final payload: choose credit note if it's a refund, else invoice
-        final_payload = creditnote if is_refund else data
-        ordername = "Credit Note" if is_refund else "Invoice"
-
-        _logger.info(f"Pos Order {ordername} data: %s", final_payload)
-        return final_payload
-
-    def __get_creditnote_line_items(self, tax_mappings):
-        """Get line items in ZIMRA credit note format (with absolute values)"""
-        line_items = []
-
-        for line in self.lines:
-            # Calculate tax information using Odoo's tax computation with absolute values
-            tax_amount = 0
-            tax_code = ""
-
-            if line.tax_ids:
-                # Use Odoo's tax computation with absolute values
-                tax_results = line.tax_ids.compute_all(
-                    price_unit=abs(line.price_unit),
-                    quantity=abs(line.qty),
-                    product=line.product_id,
-                    partner=self.partner_id if hasattr(self, 'partner_id') else None
-                )
-
-                tax_amount = abs(tax_results['total_included'] - tax_results['total_excluded'])
-
-                # Get tax code from mapping
-                for tax in line.tax_ids:
-                    if tax.id in tax_mappings:
-                        tax_mapping = tax_mappings[tax.id]
-                        tax_code = tax_mapping.zimra_tax_code
-                        break
-
-            # Safely split product name into name and hscode
-            try:
-                match = re.search(r'\b\d{8,}\b', line.product_id.name)
-                if match:
-                    hscode = match.group()
-                    # Remove the HS code from the name
-                    name = re.sub(r'\b' + re.escape(hscode) + r'\b', '', line.product_id.name).strip()
-                    # Clean up multiple spaces
-                    name = re.sub(r'\s+', ' ', name)
-                else:
-                    name = line.product_id.name
-                    hscode = ''
-            except ValueError:
-                name = line.product_id.name
-                hscode = ''
-
-            # Calculate discount if applicable (ensure positive values)
-            discount_amount = 0
-            if line.discount:
-                discount_amount = abs(line.price_unit * line.qty * line.discount / 100)
-
-            # Ensure all line item values are positive
-            unit_amount = abs(line.price_subtotal_incl)
-            line_amount = abs(line.price_subtotal_incl)
-            quantity = abs(line.qty)
-
-            # Build the line item with absolute values
-            line_item = {
-                "Description": name,
-                "UnitAmount": f"{abs(unit_amount):.3f}",
-                "TaxCode": tax_code,
-                "ProductCode": hscode,
-                "LineAmount": f"{abs(line_amount):.2f}",
-                "DiscountAmount": f"{abs(discount_amount):.2f}",
-                "Quantity": f"{abs(quantity):.3f}",
+        invoice_name = self.name
+
+        # Build only the payload that is sent: credit note for refunds, else invoice
+        if is_refund:
+            final_payload = {
+                "CreditNoteId": self.name,
+                "CreditNoteNumber": self.name,
+                "OriginalInvoiceId": _RE_REFUND.sub('', self.name).strip(),
+                "Reference": self.pos_reference or '',
+                "IsTaxInclusive": True,
+                "BuyerContact": buyer_contact,
+                "Date": now_iso,
+                "LineItems": line_items,
+                "SubTotal": _f2(abs(subtotal - self.amount_tax)),
+                "TotalTax": _f2(abs(self.amount_tax)),
+                "Total": _f2(abs(self.amount_total + total_discount)),
+                "CurrencyCode": currency_code,
+                "IsRetry": bool(self.zimra_retry_count > 0),
+            }
+        else:
+            final_payload = {
+                "InvoiceId": invoice_name,
+                "InvoiceNumber": invoice_name,
+                "Reference": self.pos_reference or "",
+                "IsDiscounted": has_discount,
+                "IsTaxInclusive": True,
+                "BuyerContact": buyer_contact,
+                "Date": now_iso,
+                "LineItems": line_items,
+                "SubTotal": _f2(subtotal - self.amount_tax),
+                "TotalTax": _f2(self.amount_tax),
+                "Total": _f2(self.amount_total),
+                "CurrencyCode": currency_code,
+                "IsRetry": bool(self.zimra_retry_count > 0),
             }
 
-            line_items.append(line_item)
-
-        return line_items
+        # Payload dumps are debug-only; the fiscal number is logged at INFO on success
+        _logger.debug("Pos Order %s data: %s", "Credit Note" if is_refund else "Invoice", final_payload)
+        return final_payload
 
     def _get_original_invoice_reference(self):
 
@@ -503,13 +590,13 @@ class PosOrder(models.Model):
         return "POS Refund"
 
     def _parse_vat_field(self, vat_string):
-        import re
-
-        match_tin = re.search(r'TIN[:=]\s*(\d+)', vat_string or "")
-        tin = match_tin.group(1) if match_tin else ''
-
-        match_vat = re.search(r'VAT[:=]\s*(\d+)', vat_string or "")
-        vat = match_vat.group(1) if match_vat else ''
+        # Single scan for both labels; the first TIN and first VAT win
+        tin = vat = ''
+        for match in _RE_TIN_VAT.finditer(vat_string or ""):
+            if match.group(1) == 'TIN':
+                tin = tin or match.group(2)
+            else:
+                vat = vat or match.group(2)
 
         return tin, vat
 
@@ -535,74 +622,79 @@ class PosOrder(models.Model):
         }
 
     def __get_line_items(self, tax_mappings):
-        """ZIMRA line items without discount-only lines"""
+        """ZIMRA line items without discount-only lines.
+
+        Returns ``(line_items, total_discount, has_discount)``; ``total_discount`` is
+        the sum of the items' DiscountAmount as sent (rounded to 2 decimals).
+        """
 
         # --- Separate product lines and receipt discounts ---
         product_lines = []
         receipt_discount_total = 0.0
+        # Total before receipt discount, accumulated in the same pass
+        total_before_discount = 0.0
+        has_discount = False
 
         for line in self.lines:
+            has_discount = has_discount or self.__is_discount_line(line)
             if self.__is_receipt_discount_line(line):
                 receipt_discount_total += abs(line.price_subtotal_incl)
             else:
                 product_lines.append(line)
+                total_before_discount += line.price_subtotal_incl
 
-        # Total before receipt discount
-        total_before_discount = sum(
-            l.price_subtotal_incl for l in product_lines
-        ) or 1.0  # avoid division by zero
+        total_before_discount = total_before_discount or 1.0  # avoid division by zero
 
         line_items = []
+        total_discount = 0.0
 
         for line in product_lines:
+            # Read each numeric field once
+            price_unit = line.price_unit
+            qty = line.qty
+            discount = line.discount
+            subtotal_incl = line.price_subtotal_incl
+
             # --- Tax code ---
-            tax_code = ""
-            for tax in line.tax_ids:
-                if tax.id in tax_mappings:
-                    tax_code = tax_mappings[tax.id].zimra_tax_code
-                    break
+            tax_code = next((tax_mappings[tax_id] for tax_id in line.tax_ids.ids if tax_id in tax_mappings), "")
 
             # --- Name & HS code ---
-            name = line.product_id.name or ""
-            hscode = ""
-            match = re.search(r'\b\d{8,}\b', name)
-            if match:
-                hscode = match.group()
-                name = re.sub(r'\b' + re.escape(hscode) + r'\b', '', name).strip()
+            name, hscode = _split_hs_code(line.product_id.name or "")
 
             # --- Proportional discount allocation ---
             proportional_discount = (
                     receipt_discount_total
-                    * (line.price_subtotal_incl / total_before_discount)
+                    * (subtotal_incl / total_before_discount)
             )
 
-            final_line_amount = line.price_subtotal_incl - proportional_discount
+            final_line_amount = subtotal_incl - proportional_discount
 
             # --- Product discount (line-level) ---
             line_discount = (
-                line.price_unit * line.qty * line.discount / 100
-                if line.discount else 0
+                price_unit * qty * discount / 100
+                if discount else 0
             )
 
+            discount_amount = abs(line_discount + proportional_discount)
+            total_discount += round(discount_amount, 2)
+
             line_items.append({
                 "Description": name,
-                "UnitAmount": f"{abs(line.price_unit):.3f}",
+                "UnitAmount": _f3(abs(price_unit)),
                 "TaxCode": tax_code,
                 "ProductCode": hscode,
-                "LineAmount": f"{abs(final_line_amount):.2f}",
-                "DiscountAmount": f"{abs(line_discount + proportional_discount):.2f}",
-                "Quantity": f"{abs(line.qty):.3f}",
+                "LineAmount": _f2(abs(final_line_amount)),
+                "DiscountAmount": _f2(discount_amount),
+                "Quantity": _f3(abs(qty)),
             })
 
-        return line_items
+        return line_items, total_discount, has_discount
 
     def __is_receipt_discount_line(self, line):
-        name = (line.product_id.name or "").lower()
+        # Numeric check first: the name scan only runs for positive lines
         return (
-                '%' in name
-                or 'discount' in name
-                or 'loyalty' in name
-                or line.price_subtotal_incl < 0
+                line.price_subtotal_incl < 0
+                or _RE_RECEIPT_DISCOUNT.search(line.product_id.name or "") is not None
         )
 
     def __is_discount_line(self, line):
@@ -611,17 +703,12 @@ class PosOrder(models.Model):
         if line.discount and line.discount > 0:
             return True
 
-        # 2. Check if product name indicates a discount/loyalty
-        name = line.product_id.name.lower() if line.product_id else ""
-        discount_keywords = ['discount', 'loyalty', 'voucher', '% off']
-        if any(k in name for k in discount_keywords):
-            return True
-
-        # 3. Optional: check for negative price lines (refund/discount)
+        # 2. Optional: check for negative price lines (refund/discount)
         if line.price_subtotal_incl < 0:
             return True
 
-        return False
+        # 3. Check if product name indicates a discount/loyalty
+        return _RE_DISCOUNT.search(line.product_id.name or "") is not None
 
     def _get_customer_address(self):
         """Get customer address as a structured dictionary"""
@@ -648,83 +735,163 @@ class PosOrder(models.Model):
 
         return payment_details
 
-    @api.model
-    def create(self, vals):
-        """Override create to auto-fiscalize"""
-        order = super(PosOrder, self).create(vals)
+    @api.model_create_multi
+    def create(self, vals_list):
+        """Override create to queue auto-fiscalization"""
+        orders = super(PosOrder, self).create(vals_list)
 
-        # Auto-fiscalize if configuration allows and order is paid/invoiced/done
-        # Don't fiscalize draft orders (quotations)
-       # if order.state in ['paid', 'invoiced', 'done']:
-        config = self.env['zimra.config'].search([
-                ('company_id', '=', order.company_id.id),
-                ('active', '=', True),
-                ('auto_fiscalize', '=', True)
-            ], limit=1)
+        # Nothing is sent inside the create transaction: orders created already
+        # paid are queued, the others are queued by write() once they are paid
+        config_model = self.env['zimra.config']
+        to_fiscalize = orders._filter_zimra_to_fiscalize().filtered(
+            lambda o: config_model.get_company_config(o.company_id.id, auto_fiscalize=True)
+        )
+        if to_fiscalize:
+            to_fiscalize = to_fiscalize.with_context(skip_zimra_write=True)
+            to_fiscalize.write({'zimra_attempted': True})
+            to_fiscalize._enqueue_zimra_fiscalization()
 
-        if config:
-                result = order._send_to_zimra()
+        return orders
 
-                if not result:
-                    _logger.error(f"Auto-fiscalization failed for order {order.name}")
+    def write(self, vals):
+        res = super().write(vals)
 
-        return order
+        # Writes made by the fiscalization itself (flags, statuses) never queue anything
+        if self.env.context.get('skip_zimra_write'):
+            return res
 
+        to_fiscalize = self._filter_zimra_to_fiscalize()
+        if to_fiscalize:
+            to_fiscalize = to_fiscalize.with_context(skip_zimra_write=True)
+            # Lock BEFORE calling send, one UPDATE for the whole set
+            to_fiscalize.write({'zimra_attempted': True})
+            to_fiscalize._enqueue_zimra_fiscalization()
 
+        return res
 
-    @api.model
-    @api.model
-    def create_from_ui(self, orders, draft=False):
-        """Intercept POS orders from UI and defer fiscalization until order has proper name"""
-        created_result = super().create_from_ui(orders, draft=draft)
+    def _filter_zimra_to_fiscalize(self):
+        """Orders ready to be handed to the fiscalization queue, each at most once"""
+        # HARD GUARDS — stop loops
+        return self.filtered(lambda o: (
+            not o.zimra_attempted
+            and o.name and o.name != '/'
+            and o.state in ('paid', 'done', 'invoiced')
+            and o.zimra_status in ('pending', False)
+        ))
+
+    def _enqueue_zimra_fiscalization(self):
+        """Hand orders over to the fiscalization queue.
+
+        The queue is the set of orders flagged ``zimra_attempted`` that are still
+        ``pending``; the cron is woken up immediately. Orders whose config has
+        ``fiscalize_synchronously`` set are sent inline instead.
+        """
+        queued = self.browse()
+        for config, orders in self._grouped_by_zimra_config():
+            if not config.fiscalize_synchronously:
+                queued |= orders
+                continue
+            for order in orders:
+                _logger.info("Triggering fiscalization ONCE for order %s", order.name)
+                order._send_to_zimra(config)
 
-        if created_result and isinstance(created_result, (list, tuple)) and isinstance(created_result[0], int):
-            order_records = self.browse(created_result)
-        else:
-            order_records = created_result
+        if queued:
+            _logger.info("Queued %s POS order(s) for fiscalization", len(queued))
+            self._trigger_fiscal_queue()
 
-        for order in order_records:
-            try:
-                # Defer fiscalization until name is valid
-                if order.name == '/' or not order.name:
-                    _logger.info("Deferring fiscalization for order %s", order.id)
-                    # you can call a deferred job or just rely on write override later
-                    continue
-                # Optionally, trigger fiscalization for already named orders
-               # order._send_to_zimra()
-            except Exception as e:
-                _logger.exception("Error scheduling fiscalization for order %s: %s",
-                                  getattr(order, 'name', 'Unknown'), str(e))
-        return created_result
+    def _grouped_by_zimra_config(self):
+        """Yield ``(config, orders)`` pairs, looking the config up once per warehouse."""
+        ZimraConfig = self.env['zimra.config']
+        for warehouse, orders in self.grouped(lambda o: o.session_id.config_id.picking_type_id.warehouse_id).items():
+            yield ZimraConfig.get_active_config(warehouse.id), orders
 
-    def write(self, vals):
-        res = super().write(vals)
-
-        for order in self:
-            # HARD GUARDS — stop loops
-            if order.zimra_attempted:
-                continue
+    @api.model
+    def _trigger_fiscal_queue(self):
+        cron = self.env.ref('zimra_fiscal.ir_cron_zimra_process_pos_queue', raise_if_not_found=False)
+        if cron:
+            cron._trigger()
 
-            if not order.name or order.name == '/':
-                continue
+    @api.model
+    def _cron_process_fiscal_queue(self, limit=_FISCAL_QUEUE_BATCH):
+        """Send queued POS orders to ZIMRA.
 
-            if order.state not in ['paid', 'done', 'invoiced']:
-                continue
+        Runs on the cron's own cursor. To drain the queue faster, run more cron
+        workers: rows are claimed with SKIP LOCKED, so runs never overlap.
+        """
+        if self._process_fiscal_queue_batch(limit):
+            self._trigger_fiscal_queue()
 
-            if order.zimra_status not in ['pending', False]:
-                continue
+    @api.model
+    def _process_fiscal_queue_batch(self, limit):
+        """Claim and send up to ``limit`` queued orders; return True if more are waiting.
 
-            # Lock BEFORE calling send
-            order.zimra_attempted = True
+        Orders are claimed one at a time with ``FOR UPDATE SKIP LOCKED`` and
+        committed right after their send, so concurrent workers never send the
+        same order twice and a killed run never rolls back an order that
+        ZIMRA already received.
+        """
+        # Background sends must not spawn a chatter message per status change
+        PosOrder = self.with_context(
+            skip_zimra_write=True,
+            tracking_disable=True,
+            mail_create_nolog=True,
+            mail_notrack=True,
+        )
 
-            _logger.info(
-                "Triggering fiscalization ONCE for order %s",
-                order.name
-            )
+        success_count = fail_count = 0
+        # Only move forward, so an order left pending is not claimed twice in one run
+        last_id = 0
+
+        for _i in range(limit):
+            self.env.cr.execute("""
+                SELECT id
+                  FROM pos_order
+                 WHERE zimra_attempted AND zimra_status = 'pending' AND id > %s
+              ORDER BY id
+                 LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+            """, [last_id])
+            row = self.env.cr.fetchone()
+            if not row:
+                break
+            last_id = row[0]
+            order = PosOrder.browse(last_id)
+            try:
+                # One bad order must not roll back the rest of the batch
+                with self.env.cr.savepoint():
+                    result = order._send_to_zimra()
+                if result:
+                    success_count += 1
+                else:
+                    fail_count += 1
+            except Exception as e:
+                fail_count += 1
+                # Leave the queue: a still-pending order would be picked up again forever
+                _logger.exception("Error fiscalizing queued POS order %s", order.name)
+                order.write({
+                    'zimra_status': 'failed',
+                    'zimra_error': str(e),
+                    # The savepoint rolled back the send bookkeeping; count the attempt here
+                    'zimra_retry_count': order.zimra_retry_count + 1,
+                    'zimra_next_retry_at': self._zimra_next_retry_at(order.zimra_retry_count + 1),
+                })
 
-            order._send_to_zimra()
+            # Keep each send even if the run is killed mid-way; this also releases the row lock
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
 
-        return res
+        done = success_count + fail_count
+        if done:
+            _logger.info("Fiscalization queue pass: %d ok, %d failed", success_count, fail_count)
+        if done < limit:
+            return False
+        self.env.cr.execute("""
+            SELECT 1
+              FROM pos_order
+             WHERE zimra_attempted AND zimra_status = 'pending' AND id > %s
+             LIMIT 1
+        """, [last_id])
+        return bool(self.env.cr.fetchone())
 
     def _deferred_fiscalization(self):
         """Trigger fiscalization only if order has a valid name and config"""
@@ -768,7 +935,7 @@ class PosOrder(models.Model):
         }
 
     def action_download_fiscal_pdf(self):
-        """Download the fiscal PDF using zimra_config and refresh the page"""
+        """Download the fiscal PDF using zimra_config"""
         self.ensure_one()
 
         if not self.fiscalized_pdf:
@@ -782,10 +949,15 @@ class PosOrder(models.Model):
                 }
             }
 
-        config = self.env['zimra.config'].search([
-            ('company_id', '=', self.company_id.id),
-            ('active', '=', True)
-        ], limit=1)
+        # A fiscalized document's PDF never changes: reprints reuse the stored copy
+        if self.fiscal_pdf_attachment_id.checksum:
+            return {
+                'type': 'ir.actions.act_url',
+                'url': f'/web/content/{self.fiscal_pdf_attachment_id.id}?download=true',
+                'target': 'self',
+            }
+
+        config = self.env['zimra.config'].get_company_config(self.company_id.id)
 
         if not config:
             return {
@@ -799,36 +971,18 @@ class PosOrder(models.Model):
             }
 
         try:
-            pdf_data = config.download_pdf(self.fiscalized_pdf)
-
-            if isinstance(pdf_data, str):
-                attachment_vals = {
-                    'name': f'FiscalInvoice_{self.name}.pdf',
-                    'type': 'binary',
-                    'datas': pdf_data,
-                    'res_model': 'account.move',
-                    'res_id': self.id,
-                    'mimetype': 'application/pdf',
-                }
+            # Streamed in chunks and size-capped; the bytes go to 'raw' untouched
+            pdf_data = config.download_pdf_content(self.fiscalized_pdf)
 
-                if self.fiscal_pdf_attachment_id:
-                    self.fiscal_pdf_attachment_id.write(attachment_vals)
-                else:
-                    attachment = self.env['ir.attachment'].create(attachment_vals)
-                    self.fiscal_pdf_attachment_id = attachment.id
-
-                # Return actions: download PDF first, then reload page
-                return [
-                    {
-                        'type': 'ir.actions.act_url',
-                        'url': f'/web/content/{self.fiscal_pdf_attachment_id.id}?download=true',
-                        'target': 'self',
-                    },
-                    {
-                        'type': 'ir.actions.client',
-                        'tag': 'reload',  # refresh the page after download
-                    }
-                ]
+            if isinstance(pdf_data, bytes):
+                self._store_fiscal_pdf(pdf_data)
+
+                # A download URL does not leave the page, so no reload is needed
+                return {
+                    'type': 'ir.actions.act_url',
+                    'url': f'/web/content/{self.fiscal_pdf_attachment_id.id}?download=true',
+                    'target': 'self',
+                }
 
             else:
                 return {
@@ -856,14 +1010,23 @@ class PosOrder(models.Model):
     @api.model
     def cron_retry_failed_fiscalization(self):
         """Cron job to retry failed fiscalization orders"""
+        # Only retry up to 3 times, and only once the order's backoff has elapsed
+        limit = int(self.env['ir.config_parameter'].sudo().get_param(
+            'zimra_fiscal.retry_batch', _RETRY_BATCH))
         failed_orders = self.search([
             ('zimra_status', '=', 'failed'),
-            ('zimra_retry_count', '<', 3)  # Only retry up to 3 times
-        ])
-
-        for order in failed_orders:
-            try:
-                order._send_to_zimra()
-                _logger.info(f"Successfully retried fiscalization for order: {order.name}")
-            except Exception as e:
-                _logger.error(f"Failed to retry fiscalization for order {order.name}: {str(e)}")
+            ('zimra_retry_count', '<', _RETRY_MAX_ATTEMPTS),
+            '|', ('zimra_next_retry_at', '=', False), ('zimra_next_retry_at', '<=', fields.Datetime.now()),
+        ], limit=limit, order='zimra_retry_count, id')
+
+        if not failed_orders:
+            return
+
+        # Only re-queue here: the queue cron does the sending, so this run never
+        # blocks on ZIMRA and several workers can drain the queue in parallel
+        failed_orders.with_context(skip_zimra_write=True, tracking_disable=True).write({
+            'zimra_status': 'pending',
+            'zimra_attempted': True,
+        })
+        self._trigger_fiscal_queue()
+        _logger.info(f"Re-queued {len(failed_orders)} failed POS orders for fiscalization")
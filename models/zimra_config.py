@@ -3,17 +3,87 @@ from email.policy import default
 
 from odoo import models, fields, api
 from odoo.exceptions import ValidationError
+from odoo.tools import ormcache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import json
 import logging
 import hmac
 import hashlib
 import base64
+import threading
 from datetime import datetime, time
 import time
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 _logger = logging.getLogger(__name__)
 
+# Writing any of these invalidates the ormcached lookups below
+_CACHE_KEY_FIELDS = {'tax_mapping_ids', 'currency_mapping_ids', 'company_id', 'warehouse_id', 'active',
+                     'auto_fiscalize'}
+
+# Responses refused before any processing (rate limited / unavailable): safe to
+# send again later. Other 5xx may come after the upstream recorded the request.
+_TRANSIENT_STATUS_CODES = (429, 503)
+
+# Fiscal PDFs are streamed in chunks and capped to guard against runaway bodies
+_PDF_CHUNK_SIZE = 64 * 1024
+_PDF_MAX_SIZE = 20 * 1024 * 1024
+
+# One keep-alive session per (database, config): TLS handshakes are paid once per
+# worker instead of once per request. Requests are sent once; retries are
+# scheduled by the callers' crons.
+_SESSION_POOL_SIZE = 10
+_SESSION_RESET_FIELDS = {'api_url', 'active'}
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def _dumps_compact(data):
+    """Serialize to compact UTF-8 JSON text, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+
+class ZimraTransientError(ValidationError):
+    """Fiscal Harmony could not be reached or asked to be retried later."""
+
+
+class ZimraPermanentError(ValidationError):
+    """Fiscal Harmony rejected the request; sending it again cannot succeed."""
+
+
+class ZimraUncertainError(ValidationError):
+    """The request may have been recorded by Fiscal Harmony; check before sending it again."""
+
+
+class ZimraStatusPendingError(ZimraTransientError):
+    """Fiscal Harmony accepted the document but its status could not be read.
+
+    ``request_id`` identifies the accepted request: poll it with
+    ``check_fiscal_request`` instead of sending the document again.
+    """
+
+    def __init__(self, message, request_id):
+        super().__init__(message)
+        self.request_id = request_id
+
+
+def _failed_before_send(error):
+    """True if a requests ConnectionError happened while connecting, before anything was sent"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # urllib3's MaxRetryError wraps the underlying connection error
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, NewConnectionError)
+
 
 class ZimraConfig(models.Model):
     _name = 'zimra.config'
@@ -40,6 +110,10 @@ class ZimraConfig(models.Model):
     timeout = fields.Integer('Request Timeout (seconds)', default=30)
     auto_fiscalize = fields.Boolean('Auto Fiscalize', default=True,
                                     help='Automatically fiscalize POS orders when paid')
+    fiscalize_synchronously = fields.Boolean(
+        'Fiscalize Synchronously', default=False,
+        help='Send paid POS orders to Fiscal Harmony inside the POS request instead of '
+             'queueing them for the background job. Intended for testing.')
     retry_count = fields.Integer('Retry Count', default=8,
                                  help='Number of times to retry failed requests')
 
@@ -61,6 +135,10 @@ class ZimraConfig(models.Model):
     # Only one active configuration per company is enforced via Python constraint
     _sql_constraints = []
 
+    # Active-config lookups filter on company/warehouse and active; keep them index probes.
+    # Not unique: several warehouses of one company may each have an active configuration.
+    _company_active_idx = models.Index("(company_id) WHERE active")
+
     @api.model
     def get_active_config(self, company_id=None):
         """Get the active configuration for the current or specified company."""
@@ -102,10 +180,7 @@ class ZimraConfig(models.Model):
     @api.model
     def get_active_config(self, warehouse_id=None):
         """Fetch active config for a given warehouse."""
-        domain = [('active', '=', True)]
-        if warehouse_id:
-            domain.append(('warehouse_id', '=', warehouse_id))
-        config = self.search(domain, limit=1)
+        config = self.browse(self._get_warehouse_config_id(warehouse_id or False))
         if not config:
             _logger.warning(f"No active ZIMRA configuration found for warehouse {warehouse_id}")
         return config
@@ -160,6 +235,70 @@ class ZimraConfig(models.Model):
                         "Please deactivate it first or set this configuration as inactive."
                     )
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        configs = super().create(vals_list)
+        self.env.registry.clear_cache()
+        return configs
+
+    def write(self, vals):
+        res = super().write(vals)
+        # Request bookkeeping (last_successful_request, ...) must not flush the caches
+        if _CACHE_KEY_FIELDS.intersection(vals):
+            self.env.registry.clear_cache()
+        if _SESSION_RESET_FIELDS.intersection(vals):
+            self._close_http_sessions()
+        return res
+
+    def unlink(self):
+        self._close_http_sessions()
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
+
+    def _close_http_sessions(self):
+        """Drop the pooled HTTP sessions of these configs; the next request opens a fresh one."""
+        with _SESSIONS_LOCK:
+            sessions = [_SESSIONS.pop((self.env.cr.dbname, config_id), None) for config_id in self.ids]
+        for session in sessions:
+            if session is not None:
+                session.close()
+
+    @api.model
+    @ormcache('company_id', 'auto_fiscalize')
+    def _get_active_config_id(self, company_id, auto_fiscalize=False):
+        """Id of the first active configuration of a company. Cached; cleared whenever a configuration changes."""
+        domain = [('company_id', '=', company_id), ('active', '=', True)]
+        if auto_fiscalize:
+            domain.append(('auto_fiscalize', '=', True))
+        return self.sudo().search(domain, limit=1).id
+
+    @api.model
+    @ormcache('warehouse_id')
+    def _get_warehouse_config_id(self, warehouse_id):
+        """Id of the first active configuration of a warehouse (any warehouse if not given). Cached."""
+        domain = [('active', '=', True)]
+        if warehouse_id:
+            domain.append(('warehouse_id', '=', warehouse_id))
+        return self.sudo().search(domain, limit=1).id
+
+    @api.model
+    def get_company_config(self, company_id, auto_fiscalize=False):
+        """Active configuration of a company, without querying the table on every call."""
+        return self.browse(self._get_active_config_id(company_id, auto_fiscalize))
+
+    @ormcache('self.id')
+    def _get_tax_code_map(self):
+        """Map Odoo tax id -> ZIMRA tax code. Cached; cleared whenever a mapping changes."""
+        self.ensure_one()
+        return {tm.odoo_tax_id.id: tm.zimra_tax_code for tm in self.tax_mapping_ids}
+
+    @ormcache('self.id')
+    def _get_currency_code_map(self):
+        """Map Odoo currency id -> ZIMRA currency code. Cached; cleared whenever a mapping changes."""
+        self.ensure_one()
+        return {cm.odoo_currency_id.id: cm.zimra_currency_code for cm in self.currency_mapping_ids}
+
     @api.constrains('api_key')
     def _check_api_key(self):
         for record in self:
@@ -227,13 +366,28 @@ class ZimraConfig(models.Model):
         _logger.info(f"{log_message} - URL: {log_data.get('request_url', 'N/A')}")
 
         if log_data.get('response'):
-            _logger.debug(f"Response: {log_data['response']}")
-
-    def __make_request(self, route: str) -> requests.Response:
+            _logger.debug("Response: %s", log_data['response'])
+
+    def __get_session(self) -> requests.Session:
+        """Return the keep-alive session shared by all requests of this config."""
+        key = (self.env.cr.dbname, self.id)
+        session = _SESSIONS.get(key)
+        if session is None:
+            with _SESSIONS_LOCK:
+                session = _SESSIONS.get(key)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_SESSION_POOL_SIZE)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    _SESSIONS[key] = session
+        return session
+
+    def __make_request(self, route: str, stream: bool = False) -> requests.Response:
         """Generates and processes a standard GET request to the Fiscal Harmony API."""
         request_url = self.__get_request_url(route)
         headers = self.__get_authheaders()
-        _logger.info(f"Request Headers: {headers}")
+        _logger.debug("Request Headers: %s", headers)
 
         log_data = {
             "request_url": request_url,
@@ -242,10 +396,11 @@ class ZimraConfig(models.Model):
         }
 
         try:
-            response = requests.get(
+            response = self.__get_session().get(
                 request_url,
                 headers=headers,
                 timeout=self.timeout,
+                stream=stream,
             )
 
             log_data["response_status_code"] = response.status_code
@@ -292,11 +447,12 @@ class ZimraConfig(models.Model):
             raise ValidationError(error_message)
 
         except Exception as e:
+            # Any other failure cannot prove the request never reached the upstream
             log_data["status"] = "Failure"
             log_data["error_details"] = str(e)
             log_data["response_status_code"] = 500
             self.__log_request(log_data)
-            raise ValidationError(f"Request error: {str(e)}")
+            raise ZimraUncertainError(f"Request error: {str(e)}; the request may have been recorded.")
 
         self.__log_request(log_data)
         return response
@@ -312,30 +468,30 @@ class ZimraConfig(models.Model):
         return signature
 
     def __make_signed_request(self, route: str, data: dict | str | list, method: str = 'POST') -> requests.Response:
-        """Generates and processes a signed request to the Fiscal Harmony API."""
+        """Generates and processes a signed request to the Fiscal Harmony API.
+
+        The request is sent once; fiscal POSTs are not idempotent. Failures raise
+        ZimraTransientError when nothing can have been recorded (connect-phase
+        errors, 429/503), ZimraUncertainError when the upstream may have recorded
+        the request (read timeouts, dropped connections, other 5xx, any other
+        transport error) and ZimraPermanentError for other 4xx.
+        """
         request_url = self.__get_request_url(route)
 
         body = ""
         if method.upper() in ["POST", "PUT", "PATCH"]:
-            if isinstance(data, dict):
-                _logger.info("Converting dict to Json %s", data)
-                body = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
-            elif isinstance(data, list):
-                _logger.info("Converting list to Json %s", data)
-                body = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
-                _logger.info(body)
+            if isinstance(data, (dict, list)):
+                body = _dumps_compact(data)
+                _logger.debug("Converted payload to Json %s", body)
             else:
-                try:
-                    parsed_data = json.loads(data)
-                    body = json.dumps(parsed_data, separators=(',', ':'), ensure_ascii=False)
-                    _logger.info("successfully loaded json %s", body)
-                except json.JSONDecodeError:
-                    _logger.info("no need to  format to json using as is %s", data)
-                    body = data
+                # Already serialized by the caller: sign and send the text as given
+                # rather than parsing and re-encoding it
+                body = data
+                _logger.debug("Sending serialized payload as is %s", body)
 
         headers = self.__get_signed_headers(body)
-        _logger.info(f"Request URL: {request_url}")
-        _logger.info(f"Request Headers: {headers}")
+        _logger.debug("Request URL: %s", request_url)
+        _logger.debug("Request Headers: %s", headers)
 
         log_data = {
             "request_url": request_url,
@@ -344,59 +500,48 @@ class ZimraConfig(models.Model):
             "timestamp": datetime.now().isoformat()
         }
 
-        _logger.info("sending this object for fiscalisation %s", log_data)
+        _logger.debug("sending this object for fiscalisation %s", log_data)
+
+        if method.upper() not in ('POST', 'PUT', 'PATCH'):
+            raise ValidationError(f"Unsupported HTTP method: {method}")
 
         try:
-            if method.upper() == 'POST':
-                response = requests.post(
-                    request_url,
-                    data=body,
-                    headers=headers,
-                    timeout=self.timeout,
-                )
-            elif method.upper() == 'PUT':
-                response = requests.put(
-                    request_url,
-                    data=body,
-                    headers=headers,
-                    timeout=self.timeout,
-                )
-            elif method.upper() == 'PATCH':
-                response = requests.patch(
-                    request_url,
-                    data=body,
-                    headers=headers,
-                    timeout=self.timeout,
-                )
-            else:
-                raise ValidationError(f"Unsupported HTTP method: {method}")
+            response = self.__get_session().request(
+                method.upper(),
+                request_url,
+                data=body,
+                headers=headers,
+                timeout=self.timeout,
+            )
 
             log_data["response_status_code"] = response.status_code
 
-            try:
-                response_json = response.text
-                _logger.info("response plain %s", response.text)
-                log_data["response"] = json.dumps(response_json, indent=2)
-            except json.JSONDecodeError:
-                log_data["response"] = response.text
+            _logger.debug("response plain %s", response.text)
+            log_data["response"] = response.text
 
             response.raise_for_status()
             log_data["status"] = "Success"
             self.__update_last_successful_request()
 
-        except requests.exceptions.Timeout:
+        except requests.exceptions.ConnectionError as e:
+            # Includes connect timeouts; only failures while connecting are safe to resend
             log_data["status"] = "Failure"
-            log_data["error_details"] = f"Connection timed out after {self.timeout} seconds"
+            log_data["error_details"] = "Connection error"
             log_data["response_status_code"] = 500
             self.__log_request(log_data)
-            raise ValidationError("The connection timed out.")
+            if _failed_before_send(e):
+                raise ZimraTransientError(
+                    "Unable to connect to ZIMRA API. Please check your internet connection and API URL.")
+            raise ZimraUncertainError(
+                "The connection to ZIMRA API was lost after the request was sent; it may have been recorded.")
 
-        except requests.exceptions.ConnectionError:
+        except requests.exceptions.Timeout:
             log_data["status"] = "Failure"
-            log_data["error_details"] = "Connection error"
+            log_data["error_details"] = f"Connection timed out after {self.timeout} seconds"
             log_data["response_status_code"] = 500
             self.__log_request(log_data)
-            raise ValidationError("Unable to connect to ZIMRA API. Please check your internet connection and API URL.")
+            raise ZimraUncertainError(
+                f"ZIMRA API did not answer within {self.timeout} seconds; the request may have been recorded.")
 
         except requests.exceptions.HTTPError:
             log_data["error_details"] = response.reason
@@ -408,14 +553,21 @@ class ZimraConfig(models.Model):
                 error_message = f"HTTP Error {response.status_code}: {response.reason}"
 
             self.__log_request(log_data)
-            raise ValidationError(error_message)
+            # 429/503 are refused up front; other 5xx may follow a recorded request;
+            # any other 4xx is a rejected request
+            if response.status_code in _TRANSIENT_STATUS_CODES:
+                raise ZimraTransientError(error_message)
+            if response.status_code >= 500:
+                raise ZimraUncertainError(error_message)
+            raise ZimraPermanentError(error_message)
 
         except Exception as e:
+            # Any other failure cannot prove the request never reached the upstream
             log_data["status"] = "Failure"
             log_data["error_details"] = str(e)
             log_data["response_status_code"] = 500
             self.__log_request(log_data)
-            raise ValidationError(f"Request error: {str(e)}")
+            raise ZimraUncertainError(f"Request error: {str(e)}; the request may have been recorded.")
 
         self.__log_request(log_data)
         return response
@@ -438,7 +590,7 @@ class ZimraConfig(models.Model):
         headers["Content-Type"] = "application/json"
         data = json.dumps(payload)
         url = self.__get_request_url(route)
-        response = requests.post(url, headers=headers, data=data, timeout=self.timeout)
+        response = self.__get_session().post(url, headers=headers, data=data, timeout=self.timeout)
 
         if response.status_code in [200, 201]:
             _logger.info(response)
@@ -463,7 +615,7 @@ class ZimraConfig(models.Model):
         headers["Content-Type"] = "application/json"
         data = json.dumps(payload)
         url = self.__get_request_url(route)
-        response = requests.post(url, headers=headers, data=data, timeout=self.timeout)
+        response = self.__get_session().post(url, headers=headers, data=data, timeout=self.timeout)
 
         if response.status_code in [200, 201]:
             _logger.info(response)
@@ -506,50 +658,82 @@ class ZimraConfig(models.Model):
                 }
             }
 
-    def send_fiscal_data(self, data, route: str = "/invoice") -> dict:
-        """Send fiscal data to ZIMRA API with signature."""
+    def send_fiscal_data(self, data, route: str = "/invoice", return_raw: bool = False):
+        """Send fiscal data to ZIMRA API with signature.
+
+        With ``return_raw`` a ``(parsed, raw_text)`` tuple is returned, so callers can
+        store the status response verbatim instead of re-serializing it. If the
+        document is accepted but its status cannot be read, ZimraStatusPendingError
+        is raised: poll it with ``check_fiscal_request`` rather than sending again.
+        """
         self.ensure_one()
+        parsed, raw_text = self.__send_fiscal_data(data, route)
+        return (parsed, raw_text) if return_raw else parsed
 
+    def __send_fiscal_data(self, data, route: str) -> tuple:
         if isinstance(data, str):
             try:
                 preview = json.loads(data)
             except json.JSONDecodeError:
                 _logger.error("Invalid JSON passed to send_fiscal_data")
-                return {"status": "error", "reason": "invalid JSON"}
+                return {"status": "error", "reason": "invalid JSON"}, ""
         elif isinstance(data, dict):
             preview = data
         else:
             _logger.error(f"Unsupported type for data: {type(data)}")
-            return {"status": "error", "reason": "unsupported data type"}
+            return {"status": "error", "reason": "unsupported data type"}, ""
 
         ref = preview.get("Reference", "")
         if isinstance(ref, str) and ref.startswith("Shop/"):
             _logger.info(f"Skipping fiscalisation for reference starting with 'Shop/': {ref}")
-            return {"status": "skipped", "reason": "Shop reference"}
+            return {"status": "skipped", "reason": "Shop reference"}, ""
 
         try:
             response = self.__make_signed_request(route, data)
-            _logger.info(" Transaction response string: %s", response.text.strip())
-            parsed = response.text.strip()
-            fiscalstatus = [parsed]
-            _logger.info("StatusString %s", fiscalstatus)
-
-            time.sleep(6)
-            response = self.check_fiscalisation_status(fiscalstatus, "/status")
-
-            return response
         except Exception as e:
             _logger.error(f"Failed to send fiscal data: {str(e)}")
             raise
 
-    def check_fiscalisation_status(self, data: list, route: str = "/status") -> dict:
+        # Accepted: from here on the document is only polled, never posted again
+        request_id = response.text.strip()
+        _logger.debug(" Transaction response string: %s", request_id)
+
+        time.sleep(6)
+        try:
+            return self.check_fiscal_request(request_id)
+        except ZimraPermanentError as e:
+            # The document was accepted, so it must not be posted again; leave it to a manual check
+            raise ZimraUncertainError(
+                f"Fiscal Harmony accepted request {request_id} but refused its status: {e}") from e
+
+    def check_fiscal_request(self, request_id: str) -> tuple:
+        """Status of a request Fiscal Harmony already accepted, as a ``(parsed, raw_text)`` tuple.
+
+        Raises ZimraStatusPendingError, carrying ``request_id``, when the status
+        cannot be read, so the caller can poll again later instead of re-sending.
+        ZimraPermanentError (the request is unknown or expired) is raised as is:
+        polling it again cannot succeed.
+        """
+        self.ensure_one()
+        try:
+            return self.check_fiscalisation_status([request_id], "/status", return_raw=True)
+        except ZimraPermanentError:
+            raise
+        except Exception as e:
+            raise ZimraStatusPendingError(
+                f"Fiscal Harmony accepted request {request_id} but its status could not be read: {e}",
+                request_id,
+            ) from e
+
+    def check_fiscalisation_status(self, data: list, route: str = "/status", return_raw: bool = False):
         """Send fiscal data to ZIMRA API with signature."""
         self.ensure_one()
 
         try:
             response = self.__make_signed_request(route, data)
-            _logger.info(" Transaction response: %s", response.json())
-            return response.json()
+            parsed = response.json()
+            _logger.debug(" Transaction response: %s", parsed)
+            return (parsed, response.text) if return_raw else parsed
         except Exception as e:
             _logger.error(f"Failed to check status: {str(e)}")
             raise
@@ -636,13 +820,34 @@ class ZimraConfig(models.Model):
         """Download and show Fiscal PDF in POS modal."""
         self.ensure_one()
 
-        response = self.__make_request(f"/download/{fiscalpdf}")
+        # Streamed and size-capped; prefer download_pdf_content when bytes will do
+        pdf_content = self.download_pdf_content(fiscalpdf)
 
-        if response.status_code == 200:
-            pdf_data = base64.b64encode(response.content).decode()
-            return pdf_data
+        if isinstance(pdf_content, bytes):
+            return base64.b64encode(pdf_content).decode()
         else:
-            return response.status_code
+            return pdf_content
+
+    def download_pdf_content(self, fiscalpdf: str):
+        """Download the Fiscal PDF as raw bytes, streaming the body in chunks.
+
+        Returns the HTTP status code instead of bytes when the download fails.
+        """
+        self.ensure_one()
+
+        response = self.__make_request(f"/download/{fiscalpdf}", stream=True)
+        with response:
+            if response.status_code != 200:
+                return response.status_code
+
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=_PDF_CHUNK_SIZE):
+                size += len(chunk)
+                if size > _PDF_MAX_SIZE:
+                    raise ValidationError(f"Fiscal PDF {fiscalpdf} exceeds {_PDF_MAX_SIZE} bytes")
+                chunks.append(chunk)
+            return b"".join(chunks)
 
     def sync_device_taxes(self):
         """Sync taxes from device endpoint to local tax mappings."""
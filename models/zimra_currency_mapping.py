@@ -21,6 +21,23 @@ class ZimraCurrencyMapping(models.Model):
         for record in self:
             record.display_name = f"{record.odoo_currency_id.name} → {record.zimra_currency_code}"
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        # zimra.config caches its currency code map
+        self.env.registry.clear_cache()
+        return records
+
+    def write(self, vals):
+        result = super().write(vals)
+        self.env.registry.clear_cache()
+        return result
+
+    def unlink(self):
+        result = super().unlink()
+        self.env.registry.clear_cache()
+        return result
+
     @api.constrains('zimra_currency_code')
     def _check_currency_code(self):
         for record in self:
@@ -94,7 +94,9 @@ class ZimraInvoice(models.Model):
     def open_downloaded_invoice(self):
         """Open the form view of the selected invoice using the PDF name from POS order"""
         self.ensure_one()
-        config = self.env['zimra.config'].search([], limit=1)
+        config = self.env['zimra.config'].get_company_config(self.company_id.id)
+        if not config:
+            raise UserError("No active FiscalHarmony configuration found for this company.")
 
         # Ensure pos_order_id is set and has the fiscalized_pdf field
         if not self.pos_order_id or not self.pos_order_id.fiscalized_pdf:
@@ -103,15 +105,16 @@ class ZimraInvoice(models.Model):
         # Get the PDF name or ID from the POS Order
         pdf_name = self.pos_order_id.fiscalized_pdf
 
-        # Call the config to download the PDF
-        response = config.download_pdf(pdf_name)
-        pdffile = response  # Base64 encoded PDF
+        # Call the config to download the PDF as raw bytes
+        pdf_data = config.download_pdf_content(pdf_name)
+        if not isinstance(pdf_data, bytes):
+            raise UserError(f"Failed to download PDF. Server returned status code: {pdf_data}")
 
-        # Store PDF temporarily in attachment
+        # Store PDF temporarily in attachment; 'raw' skips the base64 round trip
         attachment = self.env['ir.attachment'].create({
             'name': f'{pdf_name}.pdf',
             'type': 'binary',
-            'datas': pdffile,
+            'raw': pdf_data,
             'res_model': 'zimra.invoice',
             'res_id': self.id,
             'mimetype': 'application/pdf',
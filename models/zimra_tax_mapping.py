@@ -82,6 +82,12 @@ class ZimraTaxMapping(models.Model):
         result = super().write(vals)
         # Don't auto-sync during write to avoid errors
         # Users can manually sync using the save_line_taxmapping button
+        self.env.registry.clear_cache()
+        return result
+
+    def unlink(self):
+        result = super().unlink()
+        self.env.registry.clear_cache()
         return result
 
     @api.model
@@ -99,6 +105,7 @@ class ZimraTaxMapping(models.Model):
 
         # Don't auto-sync during creation to avoid errors
         # Users can manually sync using the save_line_taxmapping button
+        self.env.registry.clear_cache()
 
         return records
 